@@ -16,6 +16,40 @@ if not os.path.exists(data_dir):
 
 config = {
     'omnireader': {
-        'local_cdf_dir': data_dir
+        'local_cdf_dir': data_dir,
+        'prefetch_workers': 4, #Files downloaded at once when building an interval
+        'http_pool_size': 10, #Keep-alive connections kept open per host
+        'proxy_timeout': 62.75, #Seconds
+        'nasa_timeout': 32.75, #Seconds
+        'download_chunk_size': 64*1024, #Bytes in memory at a time while downloading
+        'download_retries': 3, #Times a broken download is resumed before giving up
+        'listing_cache_ttl': 3600., #Seconds before remote directories are listed again
+        'listing_cache_on_disk': False, #Keep listings in local_cdf_dir between runs
+        'yadisk_max_concurrent': 4, #Yandex Disk operations at once per token
+        'mirror_workers': 4, #Files copied at once by omni_mirror
+        'local_cache_max_bytes': None, #Size local_cdf_dir is kept under (None for no limit)
+        'offline': False, #Use only the files already in local_cdf_dir, never the network
+        'tiers': [{'type': 'yadisk'}], #Where files missing from local_cdf_dir are fetched from, in order
+        'request_rate': None, #Requests per second to each server (None for no limit)
+        'request_burst': 4, #Requests sent at once before request_rate applies
+        'max_concurrent': {'nasa': 4, 'proxy': 4}, #Requests at once at most per server, halved when it pushes back
+        'throttle_retries': 5, #Times a request answered with 429 or 5xx is retried
+        'backoff_max': 60., #Longest wait between those retries, seconds
+        'negative_cache_ttl': 86400., #Seconds before asking again for a file a server did not have
+        'negative_cache_recent_ttl': 3600., #The same for files ending less than negative_cache_recent_days ago
+        'negative_cache_recent_days': 62,
+        'readahead_files': 0, #Files after the one opened fetched in the background, for month by month scans
+        'readahead_workers': 2, #Threads fetching them
+        'readahead_max_bytes': 256*1024*1024, #Bytes of fetched files waiting to be used at most
+        'quarantine_dir': None, #Where corrupt files are moved to (None for a 'quarantine' dir in local_cdf_dir)
+        'corrupt_retries': 1, #Times a file which arrived corrupt is fetched again before trying the next tier
+        'compression': None, #'gzip' or 'zstd' (needs zstandard) to compress cached text files and uploads to Yandex Disk
+        'hedge_percentile': 95, #A 'hedged' tier also asks NASA when the proxy is slower to answer than this percentile
+        'hedge_delay': 2., #Seconds before also asking NASA, until enough proxy answers were timed
+        'breaker_failure_rate': .5, #Share of a server's recent requests failing for it not to be asked for a while
+        'breaker_min_calls': 4, #Requests to a server that must be known before that share counts
+        'breaker_window': 20, #Recent requests counted
+        'breaker_open_seconds': 30., #Seconds a failing server is not asked before one trial request
+        'result_cache_max_bytes': 256*1024*1024 #Memory each omni_interval keeps for variables already read
     }
 }
@@ -0,0 +1,395 @@
+import collections
+import logging
+import os
+import re
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import yadisk as yadisk
+
+from nasaomnireader import config
+from nasaomnireader.omni_circuit_breaker import get_circuit_breaker
+from nasaomnireader.omni_latency import get_latency_tracker
+from nasaomnireader.omni_rate_limiter import get_rate_limiter, ToManyRequestsError, ServerUnavailableError
+from nasaomnireader.omni_yadisk_pool import get_yadisk_pool
+
+log = logging.getLogger(__name__)
+
+# What a backend knows about one of its files, md5 is None if it can not tell cheaply
+omni_file_stat = collections.namedtuple('omni_file_stat', ['size', 'md5'])
+
+
+class DownloadCancelledError(Exception):
+    """
+    A download was stopped part way because its result is not needed any
+    more. Not a RuntimeError, as it says nothing about the backend.
+    """
+
+
+@contextmanager
+def atomic_file(localfn):
+    """
+    Yields a temporary file name next to localfn, which is renamed
+    to localfn only if the block finishes without an error, so that
+    a crash part way through a copy never leaves a truncated file
+    which looks like a cached one
+    """
+    fd, tmpfn = tempfile.mkstemp(prefix='.' + os.path.basename(localfn) + '.', suffix='.tmp',
+                                 dir=os.path.dirname(localfn) or '.')
+    os.close(fd)
+    try:
+        yield tmpfn
+        os.replace(tmpfn, localfn)
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+
+
+class omni_backend(object):
+    """
+    One tier of storage OMNI files can be read from (and maybe written
+    to). Files are found from an omni_planned_file. Operations are run
+    through call(), which paces them with the rate limiter shared by all
+    backends of the same name: at most max_concurrent at the same time
+    (None for the default of the name, config['omnireader']['max_concurrent']),
+    rate per second (None for no limit, burst at
+    most at once), retried with backoff when the backend pushes back.
+    An operation gives up after timeout seconds (None for the backend's
+    default). Operations on a backend which keeps failing fail at once
+    with a CircuitOpenError, see omni_circuit_breaker.
+
+    fetch and stat raise FileNotFoundError if the backend does not have
+    the file, a RetryableError if it asks us to slow down, and OSError
+    or RuntimeError if it could not be asked.
+    """
+    name = None
+
+    def __init__(self, max_concurrent=None, timeout=None, rate=None, burst=None):
+        self.timeout = timeout
+        limits = dict()
+        if max_concurrent is not None:
+            limits['max_concurrent'] = max_concurrent
+        if rate is not None:
+            limits['rate'] = rate
+        if burst is not None:
+            limits['burst'] = burst
+        self.limiter = get_rate_limiter(self.name, **limits)
+        self.breaker = get_circuit_breaker(self.name)
+
+    def call(self, op, *args, **kwargs):
+        """op(*args, **kwargs) paced by the backend's rate limiter, unless its circuit breaker is open"""
+        return self.breaker.call(self.limiter.call, op, *args, **kwargs)
+
+    def list(self, subpath=''):
+        """Names of the entries in the backend's folder subpath"""
+        raise NotImplementedError
+
+    def stat(self, f):
+        """omni_file_stat of the planned file f"""
+        raise NotImplementedError
+
+    def modified(self, f, headers):
+        """
+        Whether the planned file f changed since the cached copy was
+        fetched, asked with the conditional request headers (If-None-Match,
+        If-Modified-Since) of that copy. None if the backend can not tell
+        that way, then stat is compared instead.
+        """
+        return None
+
+    def fetch(self, f, localfn):
+        """Copy the planned file f to localfn, replacing localfn only once the copy is complete"""
+        raise NotImplementedError
+
+    def upload(self, localfn, f):
+        """Store localfn as the planned file f"""
+        raise NotImplementedError(f"{self.name} is read only")
+
+
+class omni_dir_backend(omni_backend):
+    """
+    A local or shared (e.g. NFS) directory holding the files flat,
+    under the same names as on Yandex Disk. timeout is not used.
+    """
+
+    def __init__(self, root, name='mirror', max_concurrent=8, **limits):
+        self.root = root
+        self.name = name
+        super(omni_dir_backend, self).__init__(max_concurrent=max_concurrent, **limits)
+
+    def list(self, subpath=''):
+        return sorted(os.listdir(os.path.join(self.root, subpath)))
+
+    def stat(self, f):
+        return omni_file_stat(os.path.getsize(os.path.join(self.root, f.filename)), None)
+
+    def fetch(self, f, localfn):
+        with atomic_file(localfn) as tmpfn:
+            shutil.copyfile(os.path.join(self.root, f.filename), tmpfn)
+
+    def upload(self, localfn, f):
+        with atomic_file(os.path.join(self.root, f.filename)) as tmpfn:
+            shutil.copyfile(localfn, tmpfn)
+
+
+class omni_yadisk_backend(omni_backend):
+    """
+    A Yandex Disk folder, used through the shared client pool
+    (which also limits the operations at once for each token)
+    """
+    name = 'yadisk'
+
+    def __init__(self, yd_token, yd_dir, pool=None, max_concurrent=None, **limits):
+        super(omni_yadisk_backend, self).__init__(max_concurrent=max_concurrent, **limits)
+        self.yd_token = yd_token
+        self.yd_dir = yd_dir
+        self.pool = get_yadisk_pool() if pool is None else pool
+
+    def _kwargs(self):
+        return dict() if self.timeout is None else {'timeout': self.timeout}
+
+    @contextmanager
+    def _client(self, path):
+        """A client from the pool, with Yandex Disk errors turned into the ones backends raise"""
+        try:
+            with self.pool.client(self.yd_token) as y:
+                yield y
+        except yadisk.exceptions.PathNotFoundError as ex:
+            raise FileNotFoundError(f"{path} is not on Yandex Disk: {str(ex)}")
+        except yadisk.exceptions.TooManyRequestsError as ex:
+            raise ToManyRequestsError(f"Too many requests to Yandex Disk for {path}: {str(ex)}")
+        except yadisk.exceptions.RetriableYaDiskError as ex:
+            raise ServerUnavailableError(f"Yandex Disk unavailable for {path}: {str(ex)}")
+        except yadisk.exceptions.YaDiskError as ex:
+            raise RuntimeError(f"Yandex Disk error for {path}: {str(ex)}")
+
+    def list(self, subpath=''):
+        path = self.yd_dir + ('/' + subpath if subpath else '')
+        with self._client(path) as y:
+            return sorted(file_inf.name for file_inf in y.listdir(path, fields=['name'], **self._kwargs()))
+
+    def stat(self, f):
+        path = self.yd_dir + '/' + f.filename
+        with self._client(path) as y:
+            meta = y.get_meta(path, fields=['md5', 'size', 'modified'], **self._kwargs())
+        return omni_file_stat(meta.size, meta.md5)
+
+    def fetch(self, f, localfn):
+        path = self.yd_dir + '/' + f.filename
+        with atomic_file(localfn) as tmpfn, self._client(path) as y:
+            y.download(path, tmpfn, **self._kwargs())
+
+    def upload(self, localfn, f):
+        path = self.yd_dir + '/' + f.filename
+        with self._client(path) as y:
+            y.upload(localfn, path, overwrite=True, timeout=60.0 if self.timeout is None else self.timeout)
+
+
+class omni_http_backend(omni_backend):
+    """
+    The NASA server, directly or (if proxy_url and proxy_key are set)
+    through the proxy. Downloads go through dwnldr.download_to_file,
+    so they stream, resume and use the shared HTTP sessions.
+    """
+
+    def __init__(self, dwnldr, proxy_url=None, proxy_key=None, max_concurrent=None, **limits):
+        self.dwnldr = dwnldr
+        self.proxy_url = proxy_url
+        self.proxy_key = proxy_key
+        self.name = 'proxy' if proxy_url is not None and proxy_key is not None else 'nasa'
+        super(omni_http_backend, self).__init__(max_concurrent=max_concurrent, **limits)
+
+    def _url(self, path):
+        return 'https://' + self.dwnldr.ftpserv + path
+
+    def list(self, subpath=''):
+        response = self.dwnldr.get_response(self._url(self.dwnldr.ftpdir + '/' + subpath),
+                                            self.proxy_url, self.proxy_key, timeout=self.timeout)
+        return sorted(set(name.rstrip('/') for name in re.findall(r'href="([^"?/][^"]*)"', response.text)))
+
+    def stat(self, f):
+        url = self._url(f.remotefn)
+        response = self.dwnldr.get_response(url, self.proxy_url, self.proxy_key, stream=True, timeout=self.timeout)
+        response.close()
+        if response.status_code == 404:
+            raise FileNotFoundError(f"{url} not found")
+        if response.status_code >= 400:
+            raise RuntimeError(f"{url} answered with code {response.status_code}")
+        size = response.headers.get('Content-Length')
+        return omni_file_stat(int(size) if size is not None else None, None)
+
+    def modified(self, f, headers):
+        if not headers:
+            return None
+        url = self._url(f.remotefn)
+        response = self.dwnldr.get_response(url, self.proxy_url, self.proxy_key, stream=True, headers=headers,
+                                            timeout=self.timeout)
+        response.close()
+        if response.status_code == 404:
+            raise FileNotFoundError(f"{url} not found")
+        if response.status_code >= 400:
+            raise RuntimeError(f"{url} answered with code {response.status_code}")
+        return response.status_code != 304
+
+    def fetch(self, f, localfn, started=None, cancel=None):
+        """
+        As omni_backend.fetch. The threading.Event started (if given) is set
+        when the server starts answering, and setting cancel stops the
+        download (see omni_downloader.download_to_file).
+        """
+        requested_at = time.monotonic()
+
+        def on_response():
+            # Time to first byte, for omni_hedged_backend to tell when a request is slow
+            get_latency_tracker(self.name).record(time.monotonic() - requested_at)
+            if started is not None:
+                started.set()
+        self.dwnldr.download_to_file(self._url(f.remotefn), localfn, self.proxy_url, self.proxy_key,
+                                     timeout=self.timeout, on_response=on_response, cancel=cancel)
+
+
+class omni_hedged_backend(omni_backend):
+    """
+    Hedged fetches from two omni_http_backend (the proxy and NASA directly):
+    a file is asked from the first, and if it has not started answering
+    after the percentile-th percentile of its recent times to first byte
+    (delay seconds until enough are known), from the second as well. The
+    first complete copy wins and the other download is cancelled (at its
+    next chunk, a request still waiting for an answer is cancelled when
+    it comes). Each source is still paced by its own rate limiter.
+    list, stat and modified only ask the first source.
+    """
+
+    def __init__(self, dwnldr, backends, percentile=95, delay=2., **limits):
+        self.dwnldr = dwnldr
+        self.backends = backends
+        self.percentile = percentile
+        self.delay = delay
+        self.name = '+'.join(backend.name for backend in backends)
+        super(omni_hedged_backend, self).__init__(**limits)
+
+    def list(self, subpath=''):
+        return self.backends[0].call(self.backends[0].list, subpath)
+
+    def stat(self, f):
+        return self.backends[0].call(self.backends[0].stat, f)
+
+    def modified(self, f, headers):
+        return self.backends[0].call(self.backends[0].modified, f, headers)
+
+    def hedge_delay(self):
+        """Seconds to wait for the first source to start answering before asking the second"""
+        return get_latency_tracker(self.backends[0].name).percentile(self.percentile, default=self.delay)
+
+    def _race(self, backend, f, tmpfn, started, cancel, results):
+        try:
+            backend.call(backend.fetch, f, tmpfn, started=started, cancel=cancel)
+            results.put((backend, tmpfn, None))
+        except Exception as ex:
+            results.put((backend, tmpfn, ex))
+        finally:
+            # A request which failed before answering must not hold up the other source
+            started.set()
+
+    def fetch(self, f, localfn):
+        results = queue.Queue()
+        cancel = threading.Event()
+        started = [threading.Event() for backend in self.backends]
+        racers = []
+
+        def start(i):
+            tmpfn = localfn + '.' + self.backends[i].name
+            thread = threading.Thread(target=self._race, daemon=True,
+                                      args=(self.backends[i], f, tmpfn, started[i], cancel, results))
+            thread.start()
+            racers.append(thread)
+
+        start(0)
+        if not started[0].wait(self.hedge_delay()):
+            log.debug(f"{self.backends[0].name} is slow to answer for {f.filename}, "
+                      f"asking {self.backends[1].name} too")
+            start(1)
+        errors = []
+        try:
+            while len(errors) < len(racers) or len(racers) < len(self.backends):
+                if len(errors) == len(racers):
+                    # Every source asked so far failed, ask the next one
+                    start(len(racers))
+                backend, tmpfn, error = results.get()
+                if error is None:
+                    os.replace(tmpfn, localfn)
+                    self._adopt_validators(tmpfn, localfn)
+                    log.debug(f"{f.filename} fetched from {backend.name}")
+                    return
+                errors.append(error)
+        finally:
+            cancel.set()
+            self._remove_temporary_files(localfn, racers)
+        if all(isinstance(error, FileNotFoundError) for error in errors):
+            raise FileNotFoundError(f"{f.filename} not found on {self.name}")
+        raise next(error for error in errors if not isinstance(error, FileNotFoundError))
+
+    def _adopt_validators(self, tmpfn, localfn):
+        """Store the validators the winning download got in the cache index under localfn's name"""
+        entry = self.dwnldr.cache_index.get(os.path.basename(tmpfn))
+        if entry is not None:
+            self.dwnldr.cache_index.put(os.path.basename(localfn), etag=entry['etag'],
+                                        last_modified=entry['last_modified'])
+
+    def _remove_temporary_files(self, localfn, racers):
+        """Once every download stopped, remove their files and cache index entries (in the background)"""
+        tmpfns = [localfn + '.' + backend.name for backend in self.backends]
+
+        def clean_up():
+            for thread in racers:
+                thread.join()
+            for tmpfn in tmpfns:
+                self.dwnldr.cache_index.remove(os.path.basename(tmpfn))
+                for fn in [tmpfn, tmpfn + '.part', tmpfn + '.part.validator']:
+                    if os.path.exists(fn):
+                        os.remove(fn)
+        threading.Thread(target=clean_up, daemon=True).start()
+
+
+def build_tiers(dwnldr, specs=None, proxy_url=None, proxy_key=None):
+    """
+    The backends dwnldr falls through, in order, for files missing from
+    its localdir. Each spec is a dict with a 'type' ('dir', 'yadisk',
+    'proxy' or 'nasa') and optionally 'max_concurrent' and 'timeout';
+    'dir' also needs a 'root' and may have a 'name'. A 'hedged' tier
+    fetches from the proxy and NASA at once, see omni_hedged_backend for
+    its optional 'percentile' and 'delay'. If specs is None they are read
+    from config['omnireader']['tiers']. The proxy tier is left out (and
+    the hedged tier only asks NASA) unless proxy_url and proxy_key are given.
+    """
+    if specs is None:
+        specs = config['omnireader'].get('tiers', [{'type': 'yadisk'}])
+    tiers = []
+    for spec in specs:
+        limits = {key: spec[key] for key in ['max_concurrent', 'timeout', 'rate', 'burst']
+                  if key in spec}
+        if spec['type'] == 'dir':
+            tiers.append(omni_dir_backend(spec['root'], name=spec.get('name', 'mirror'), **limits))
+        elif spec['type'] == 'yadisk':
+            tiers.append(omni_yadisk_backend(dwnldr.yd_token, dwnldr.yd_dir, pool=dwnldr.yadisk_pool, **limits))
+        elif spec['type'] == 'proxy':
+            if proxy_url is not None and proxy_key is not None:
+                tiers.append(omni_http_backend(dwnldr, proxy_url, proxy_key, **limits))
+        elif spec['type'] == 'nasa':
+            tiers.append(omni_http_backend(dwnldr, **limits))
+        elif spec['type'] == 'hedged':
+            if proxy_url is None or proxy_key is None:
+                tiers.append(omni_http_backend(dwnldr, **limits))
+                continue
+            omni_config = config['omnireader']
+            tiers.append(omni_hedged_backend(dwnldr, [omni_http_backend(dwnldr, proxy_url, proxy_key, **limits),
+                                                      omni_http_backend(dwnldr, **limits)],
+                                             percentile=spec.get('percentile', omni_config.get('hedge_percentile', 95)),
+                                             delay=spec.get('delay', omni_config.get('hedge_delay', 2.))))
+        else:
+            raise ValueError(f"Unknown tier type {spec['type']}")
+    return tiers
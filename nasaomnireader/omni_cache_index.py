@@ -0,0 +1,108 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+index_filename = 'omni_cache_index.sqlite'
+
+
+class omni_cache_index(object):
+    """
+    Small SQLite database kept next to the cached files in a local
+    directory, holding what we know about each cached file, keyed by
+    the file's name in the directory:
+        etag, last_modified - validators the server sent with the file
+        size - bytes
+        last_access - when the file was last used (seconds since epoch)
+        cadence, startdt, enddt - cadence and span of time (ISO format,
+            startdt inclusive, enddt exclusive) the file covers
+        checksum - md5 hex digest of the file
+        source - name of the tier the file came from ('nasa', 'proxy',
+            'yadisk' or a directory tier's name)
+        fetched_at - when the file was downloaded (seconds since epoch)
+        verified_at - when the file was last found whole and well formed
+            (seconds since epoch), None if it was not checked since fetched
+        revalidated_at - when the file was last found unchanged on the
+            tiers (seconds since epoch)
+    A file is cached if its entry has fetched_at set, entries without it
+    only remember validators or use.
+    """
+    columns = ['etag', 'last_modified', 'size', 'last_access',
+               'cadence', 'startdt', 'enddt', 'checksum', 'source', 'fetched_at', 'verified_at', 'revalidated_at']
+    column_types = {'etag': 'TEXT', 'last_modified': 'TEXT', 'size': 'INTEGER', 'last_access': 'REAL',
+                    'cadence': 'TEXT', 'startdt': 'TEXT', 'enddt': 'TEXT', 'checksum': 'TEXT',
+                    'source': 'TEXT', 'fetched_at': 'REAL', 'verified_at': 'REAL',
+                    'revalidated_at': 'REAL'}
+    _locks = dict()  # One lock per index file, shared by all instances
+    _locks_lock = threading.Lock()
+
+    def __init__(self, localdir):
+        self.dbfn = os.path.join(localdir, index_filename)
+        with omni_cache_index._locks_lock:
+            if self.dbfn not in omni_cache_index._locks:
+                omni_cache_index._locks[self.dbfn] = threading.Lock()
+            self._lock = omni_cache_index._locks[self.dbfn]
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cached_files (filename TEXT PRIMARY KEY)')
+            # Add the columns missing from an index written by an older version
+            existing = [row[1] for row in conn.execute('PRAGMA table_info(cached_files)')]
+            for column in self.columns:
+                if column not in existing:
+                    conn.execute('ALTER TABLE cached_files ADD COLUMN %s %s' % (column, self.column_types[column]))
+
+    @contextmanager
+    def _transaction(self):
+        """A connection to the index, committed and closed at the end of the block"""
+        with self._lock:
+            # Other processes may be using the same localdir, wait for their writes
+            conn = sqlite3.connect(self.dbfn, timeout=30.)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+    def get(self, filename):
+        """The stored fields for filename as a dict, or None if it is not in the index"""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT %s FROM cached_files WHERE filename=?' % ', '.join(self.columns),
+                               (filename,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.columns, row))
+
+    def put(self, filename, **fields):
+        """Store the given fields for filename, keeping any others already stored"""
+        names = [column for column in self.columns if column in fields]
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO cached_files (filename) VALUES (?)', (filename,))
+            if names:
+                conn.execute('UPDATE cached_files SET %s WHERE filename=?' % ', '.join(name + '=?' for name in names),
+                             [fields[name] for name in names] + [filename])
+
+    def all(self):
+        """The stored fields of every file in the index, as a dict keyed by file name"""
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT filename, %s FROM cached_files' % ', '.join(self.columns)).fetchall()
+        return {row[0]: dict(zip(self.columns, row[1:])) for row in rows}
+
+    def cached(self, cadence=None):
+        """
+        The stored fields of the cached files (of one cadence if given),
+        as a dict keyed by file name
+        """
+        query = 'SELECT filename, %s FROM cached_files WHERE fetched_at IS NOT NULL' % ', '.join(self.columns)
+        params = []
+        if cadence is not None:
+            query += ' AND cadence=?'
+            params.append(cadence)
+        with self._transaction() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return {row[0]: dict(zip(self.columns, row[1:])) for row in rows}
+
+    def remove(self, filename):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cached_files WHERE filename=?', (filename,))
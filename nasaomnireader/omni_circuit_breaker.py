@@ -0,0 +1,125 @@
+import collections
+import logging
+import threading
+import time
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(RuntimeError):
+    """A backend failed too often lately, it is not asked until its circuit breaker lets a trial through"""
+
+
+class omni_circuit_breaker(object):
+    """
+    Stops asking a backend which is down. The outcome of the last window
+    calls is kept; when at least min_calls of them are known and
+    failure_rate of them or more failed, the breaker opens and calls fail
+    at once with CircuitOpenError for open_seconds. Then it is half open:
+    one trial call goes through, closing the breaker if it succeeds and
+    opening it again if it fails.
+
+    A FileNotFoundError is a success, the backend answered.
+    """
+
+    def __init__(self, name, failure_rate=.5, min_calls=4, window=20, open_seconds=30.):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.outcomes = collections.deque(maxlen=window)  # True for each failed call
+        self.state = 'closed'
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Whether a call would be refused now"""
+        with self._lock:
+            if self.state == 'closed':
+                return False
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.open_seconds:
+                return False
+            return self.state == 'open' or self._trial_running
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    raise CircuitOpenError(f"{self.name} is failing, not asked for "
+                                           f"{self.open_seconds - (time.monotonic() - self._opened_at):.0f} "
+                                           f"more seconds")
+                self.state = 'half_open'
+                log.info(f"Trying {self.name} again")
+            if self.state == 'half_open':
+                if self._trial_running:
+                    raise CircuitOpenError(f"{self.name} is failing, waiting for a trial request")
+                self._trial_running = True
+
+    def _after_call(self, failed):
+        with self._lock:
+            if self.state == 'half_open':
+                self._trial_running = False
+                if failed:
+                    self._open()
+                else:
+                    log.info(f"{self.name} is back")
+                    self.state = 'closed'
+                    self.outcomes.clear()
+                return
+            self.outcomes.append(failed)
+            if (self.state == 'closed' and len(self.outcomes) >= self.min_calls
+                    and sum(self.outcomes) >= self.failure_rate * len(self.outcomes)):
+                self._open()
+
+    def _open(self):
+        log.warning(f"{self.name} is failing, not asking it for {self.open_seconds} seconds")
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        """func(*args, **kwargs), unless the breaker is open. OSError and RuntimeError count as failures."""
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except FileNotFoundError:
+            self._after_call(failed=False)
+            raise
+        except (OSError, RuntimeError):
+            self._after_call(failed=True)
+            raise
+        except BaseException:
+            # Cancelled or interrupted, says nothing about the backend
+            self._after_call(failed=False)
+            raise
+        self._after_call(failed=False)
+        return result
+
+
+_circuit_breakers = dict()
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """
+    The circuit breaker shared by everything in the process talking to
+    the backend name, configured from config['omnireader']
+    """
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            omni_config = config['omnireader']
+            _circuit_breakers[name] = omni_circuit_breaker(
+                name,
+                failure_rate=omni_config.get('breaker_failure_rate', .5),
+                min_calls=omni_config.get('breaker_min_calls', 4),
+                window=omni_config.get('breaker_window', 20),
+                open_seconds=omni_config.get('breaker_open_seconds', 30.))
+        return _circuit_breakers[name]
+
+
+def clear_circuit_breakers():
+    """Forget the shared circuit breakers (e.g. after the config changed)"""
+    with _circuit_breakers_lock:
+        _circuit_breakers.clear()
@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import io
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# zstandard is optional, without it only gzip compression is available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Raised when reading compressed data which is cut short or damaged
+decompression_errors = (EOFError, OSError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# First bytes of a file compressed with each method. Compressed files keep
+# their names, they are told from uncompressed ones by these bytes
+magic_numbers = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+chunk_size = 1024 * 1024
+
+
+def check_compression(method):
+    """Raise ValueError if method is not None, 'gzip' or 'zstd' (with zstandard installed)"""
+    if method not in (None, 'gzip', 'zstd'):
+        raise ValueError(f'Invalid compression {method!r}. Valid values are None, "gzip" and "zstd"')
+    if method == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+
+
+def compression_of(fileobj):
+    """
+    The method the bytes of fileobj from its current position on are
+    compressed with, None if they are not. The position is kept.
+    """
+    position = fileobj.tell()
+    start = fileobj.read(4)
+    fileobj.seek(position)
+    for method, magic in magic_numbers.items():
+        if start.startswith(magic):
+            return method
+    return None
+
+
+def decompressed(fileobj):
+    """
+    A binary file object reading the bytes of fileobj from its current
+    position on, decompressed as a stream if they are compressed. Several
+    compressed members one after the other (see append_file) read as one.
+    """
+    method = compression_of(fileobj)
+    if method == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if method == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(f'{getattr(fileobj, "name", "The file")} is zstd compressed, '
+                               f'reading it needs the zstandard package')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True))
+    return fileobj
+
+
+@contextmanager
+def open_file(path, offset=0):
+    """
+    Open path (compressed or not) for reading its content as bytes, from
+    offset in the file as stored (the start of a compressed member)
+
+        with open_file(localfn) as f:
+            ... f.read() ...
+    """
+    with open(path, 'rb') as fileobj:
+        fileobj.seek(offset)
+        reader = decompressed(fileobj)
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+
+def is_compressed(path):
+    with open(path, 'rb') as f:
+        return compression_of(f) is not None
+
+
+def content_stat(path):
+    """Size and md5 hex digest of the content of path (decompressed if it is compressed)"""
+    md5 = hashlib.md5()
+    size = 0
+    with open_file(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+            size += len(chunk)
+    return size, md5.hexdigest()
+
+
+def _compressed_writer(out, method):
+    if method == 'gzip':
+        # mtime 0, so the same content always compresses to the same bytes
+        return gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0)
+    return zstandard.ZstdCompressor().stream_writer(out, closefd=False)
+
+
+def compress_file(path, method):
+    """
+    Compress the file path in place with method, unless it is already
+    compressed (or method is None). The compressed file replaces it only
+    once written in full. Returns whether path was compressed.
+    """
+    if method is None or is_compressed(path):
+        return False
+    check_compression(method)
+    tmpfn = path + '.compressing'
+    with open(path, 'rb') as src, open(tmpfn, 'wb') as out:
+        with _compressed_writer(out, method) as writer:
+            shutil.copyfileobj(src, writer, chunk_size)
+    os.replace(tmpfn, path)
+    return True
+
+
+def content_tail(path, n):
+    """The last n bytes (all of it if it is shorter) of the content of path"""
+    if not is_compressed(path):
+        with open(path, 'rb') as f:
+            f.seek(max(os.path.getsize(path) - n, 0))
+            return f.read()
+    tail = b''
+    with open_file(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            tail = (tail + chunk)[-n:]
+    return tail
+
+
+def append_file(path, srcfn):
+    """
+    Append the content of the file srcfn to the file path, compressed as
+    a new member with the method path is compressed with (if any)
+    """
+    with open(path, 'rb') as f:
+        method = compression_of(f)
+    with open(path, 'ab') as out, open(srcfn, 'rb') as src:
+        if method is None:
+            shutil.copyfileobj(src, out, chunk_size)
+        else:
+            with _compressed_writer(out, method) as writer:
+                shutil.copyfileobj(src, writer, chunk_size)
@@ -37,5 +37,4 @@ class omni_event(object):
 
     def close(self):
         """Close the CDFs"""
-        for cdf in self.interval.cdfs:
-            cdf.close()
\ No newline at end of file
+        self.interval.close()
\ No newline at end of file
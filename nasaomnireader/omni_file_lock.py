@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# fcntl is only on POSIX, elsewhere files are only locked within the process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class omni_file_lock(object):
+    """
+    Exclusive lock on one file in a local directory, held by at most one
+    thread of one process at a time. Threads wait on a lock shared by the
+    process, and processes on an flock of a hidden '.<name>.lock' file
+    next to the file, so several processes can share a directory.
+
+        with omni_file_lock(localfn):
+            ... check and write localfn ...
+    """
+    _thread_locks = dict()  # path -> [threading.Lock, number of users]
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lockfn = os.path.join(os.path.dirname(self.path), '.' + os.path.basename(self.path) + '.lock')
+        self._lockfile = None
+
+    def _thread_lock(self, delta):
+        """The process lock for path, adding delta to its users (and dropping it when unused)"""
+        with omni_file_lock._thread_locks_lock:
+            entry = omni_file_lock._thread_locks.setdefault(self.path, [threading.Lock(), 0])
+            entry[1] += delta
+            if entry[1] <= 0:
+                del omni_file_lock._thread_locks[self.path]
+            return entry[0]
+
+    def __enter__(self):
+        lock = self._thread_lock(1)
+        lock.acquire()
+        try:
+            if fcntl is not None:
+                self._lockfile = open(self.lockfn, 'a')
+                fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self._release(lock)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release(self._thread_lock(0))
+
+    def _release(self, lock):
+        if self._lockfile is not None:
+            fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_UN)
+            self._lockfile.close()
+            self._lockfile = None
+        lock.release()
+        self._thread_lock(-1)
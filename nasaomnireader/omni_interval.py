@@ -1,40 +1,43 @@
 import datetime
+import time
+import weakref
 
 import numpy as np
 
+from nasaomnireader import config
+from nasaomnireader.omni_lazy_file import omni_lazy_file
+from nasaomnireader.omni_result_cache import omni_result_cache
 from nasaomnireader.omnireader import omni_downloader
 from nasaomnireader.utils import juliandate, borovsky, newell, knippjh
 
+# Bytes of finished variable arrays each interval keeps for repeated reads (None for no limit)
+result_cache_max_bytes = config['omnireader'].get('result_cache_max_bytes', 256 * 1024 * 1024)
+
 
 class omni_interval(object):
     def __init__(self, startdt, enddt, cadence, yd_token, yd_dir, silent=False, cdf_or_txt='cdf', force_download=False, proxy_url=None,
-                 proxy_key=None):
+                 proxy_key=None, revalidate=False, offline=None, readahead=None, result_cache_bytes=None):
         # log.debug("omnireader.py:482")
         # Just handles the possiblilty of having a read running between two CDFs
-        self.dwnldr = omni_downloader(yd_token, yd_dir, cdf_or_txt=cdf_or_txt, force_download=force_download)
+        # offline: use only the files already in local_cdf_dir (config['omnireader']['offline'] if None)
+        # readahead: files after the interval to fetch in the background, for month by month scans
+        # result_cache_bytes: memory kept for the arrays already read (config['omnireader']['result_cache_max_bytes'] if None)
+        self.dwnldr = omni_downloader(yd_token, yd_dir, cdf_or_txt=cdf_or_txt, force_download=force_download,
+                                      revalidate=revalidate, offline=offline, proxy_url=proxy_url,
+                                      proxy_key=proxy_key, readahead=readahead)
         self.silent = silent  # No messages
         self.cadence = cadence
         self.startdt = startdt
         self.enddt = enddt
+        self._unpin = None  # Releases this interval's files in the local cache
+        # Variables already read, returned read only without reading the files again
+        self.results = omni_result_cache(result_cache_max_bytes if result_cache_bytes is None else result_cache_bytes)
         # log.debug("omnireader.py:489")
 
         self.startdt, self.enddt = self.dwnldr.fix_interval_yadisk(self.startdt,self.enddt, cadence, proxy_url=proxy_url, proxy_key=proxy_key)
 
-        self.cdfs = [self.dwnldr.get_cdf_from_ya_disk(self.startdt, cadence, proxy_url=proxy_url, proxy_key=proxy_key)]
-        # log.debug("omnireader.py:491")
-        self.attrs = self.cdfs[-1].attrs  # Mirror the global attributes for convenience
+        self._open_cdfs(self.dwnldr, proxy_url=proxy_url, proxy_key=proxy_key)
         self.transforms = dict()  # Functions which transform data automatically on __getitem__
-        # Find the index corresponding to the first value larger than startdt
-        self.si = np.searchsorted(self.cdfs[0]['Epoch'][:], self.startdt)
-        # log.debug("omnireader.py:496")
-        while self.cdfs[-1]['Epoch'][-1] < self.enddt:
-            # Keep adding CDFs until we span the entire range
-            # log.debug("omnireader.py:499")
-            self.cdfs.append(self.dwnldr.get_cdf_from_ya_disk(self.cdfs[-1]['Epoch'][-1] + datetime.timedelta(days=1), cadence,
-                                                 proxy_url=proxy_url, proxy_key=proxy_key))
-        # Find the first index larger than the enddt in the last CDF
-        # log.debug("omnireader.py:502")
-        self.ei = np.searchsorted(self.cdfs[-1]['Epoch'][:], self.enddt)
 
         if not self.silent:
             print("Created interval between %s and %s, cadence %s, start index %d, end index %d" % (
@@ -56,11 +59,14 @@ class omni_interval(object):
 
         nan_var = None
 
-        for var in _vars:
-            values = self[var]
-            if any([np.isnan(val) for val in  values]):
-                nan_var = var
-                break
+        # Only an interval inside one file is moved when its data runs out,
+        # longer ones are not scanned so that their files stay unopened
+        if len(self.cdfs) == 1:
+            for var in _vars:
+                values = self[var]
+                if np.any(np.isnan(values)):
+                    nan_var = var
+                    break
 
         if nan_var is not None:
             if len(self.cdfs) == 1:
@@ -69,7 +75,8 @@ class omni_interval(object):
                 values = self.cdfs[0][nan_var][:]
                 is_nan = np.isnan(values)
 
-                ei = self.ei
+                # The interval can end exactly at the end of the file
+                ei = min(self.ei, len(values) - 1)
                 while is_nan[ei] and ei>0:
                     ei-=1
 
@@ -79,24 +86,13 @@ class omni_interval(object):
                     self.enddt = self.cdfs[0]['Epoch'][0] - datetime.timedelta(days=2)
                     self.startdt = self.enddt - timespan
 
-                    dwnldr = omni_downloader(yd_token, yd_dir, cdf_or_txt=cdf_or_txt, force_download=True)
+                    # Pick up any update of the files since they were cached
+                    dwnldr = omni_downloader(yd_token, yd_dir, cdf_or_txt=cdf_or_txt,
+                                             revalidate=not self.dwnldr.offline, offline=self.dwnldr.offline,
+                                             tiers=self.dwnldr.tiers)
 
-                    self.cdfs = [dwnldr.get_cdf_from_ya_disk(self.startdt, cadence, proxy_url=proxy_url, proxy_key=proxy_key)]
-                    # log.debug("omnireader.py:491")
-                    self.attrs = self.cdfs[-1].attrs  # Mirror the global attributes for convenience
+                    self._open_cdfs(dwnldr, proxy_url=proxy_url, proxy_key=proxy_key)
                     self.transforms = dict()  # Functions which transform data automatically on __getitem__
-                    # Find the index corresponding to the first value larger than startdt
-                    self.si = np.searchsorted(self.cdfs[0]['Epoch'][:], self.startdt)
-                    # log.debug("omnireader.py:496")
-                    while self.cdfs[-1]['Epoch'][-1] < self.enddt:
-                        # Keep adding CDFs until we span the entire range
-                        # log.debug("omnireader.py:499")
-                        self.cdfs.append(
-                            self.dwnldr.get_cdf_from_ya_disk(self.cdfs[-1]['Epoch'][-1] + datetime.timedelta(days=1), cadence,
-                                                proxy_url=proxy_url, proxy_key=proxy_key))
-                    # Find the first index larger than the enddt in the last CDF
-                    # log.debug("omnireader.py:502")
-                    self.ei = np.searchsorted(self.cdfs[-1]['Epoch'][:], self.enddt)
 
                     if not self.silent:
                         print("Created interval between %s and %s, cadence %s, start index %d, end index %d" % (
@@ -115,6 +111,7 @@ class omni_interval(object):
 
                     self.si = si
                     self.ei = ei
+                    self._forget_results()
 
                     self.startdt = self.cdfs[0]['Epoch'][self.si]
                     self.enddt = self.cdfs[0]['Epoch'][self.ei]
@@ -124,6 +121,83 @@ class omni_interval(object):
                     self.computed['newell'] = newell(self)
                     self.computed['knippjh'] = knippjh(self)
 
+    def _open_cdfs(self, dwnldr, proxy_url=None, proxy_key=None):
+        """
+        Plan the files for startdt to enddt (fetching any missing ones
+        with dwnldr first) and find the start and end indices. The files
+        are opened when their variables are first read (see omni_lazy_file).
+        """
+        self._forget_results()
+        self.files = self.dwnldr.plan_files(self.startdt, self.enddt, self.cadence)
+        self._pin_files([f.filename for f in self.files])
+        # Fetch all the files for the interval at once, so opening them only reads local files
+        # (and, with force_download, does not download them again)
+        fetched_since = time.time()
+        dwnldr.prefetch_from_ya_disk(self.startdt, self.enddt, self.cadence)
+        self.cdfs = [omni_lazy_file(self.dwnldr, f, proxy_url=proxy_url, proxy_key=proxy_key,
+                                    fetched_since=fetched_since) for f in self.files]
+        # Find the index corresponding to the first value larger than startdt
+        self.si = self.cdfs[0].index(self.startdt)
+        # Find the first index larger than the enddt in the last CDF
+        self.ei = self.cdfs[-1].index(self.enddt)
+
+    def _forget_results(self):
+        """Forget the variables already read, after what the interval holds changed"""
+        self.results.clear()
+        for derived in getattr(self, 'computed', dict()).values():
+            derived.varvals = None
+
+    @property
+    def attrs(self):
+        """Mirror the global attributes of the last file for convenience"""
+        return self.cdfs[-1].attrs
+
+    def refresh(self, enddt=None, proxy_url=None, proxy_key=None):
+        """
+        Pick up the records NASA added to the interval's last file since
+        it was opened, fetching only the new part of the file (see
+        omni_downloader.refresh_tail). Text files are extended in memory,
+        a changed CDF is opened again. If enddt is given the interval
+        is extended to it, it must be inside the last file.
+        Returns True if the last file changed.
+        """
+        last = self.files[-1]
+        if enddt is not None:
+            if enddt > last.enddt:
+                raise ValueError(f"{enddt} is past the last file of the interval ({last.filename}), "
+                                 f"create a new interval instead")
+            self.enddt = enddt
+        appended_from = self.dwnldr.refresh_tail(last.startdt, self.cadence, proxy_url=proxy_url,
+                                                 proxy_key=proxy_key)
+        if appended_from is not None and self.cdfs[-1].is_open:
+            if appended_from > 0 and hasattr(self.cdfs[-1].open(), 'extend'):
+                self.cdfs[-1].open().extend(appended_from)
+            else:
+                # Opened again with the new content on next use
+                self.cdfs[-1].close()
+        self.ei = self.cdfs[-1].index(self.enddt)
+        if len(self.cdfs) == 1:
+            self.si = self.cdfs[0].index(self.startdt)
+        self._forget_results()
+        return appended_from is not None
+
+    def _pin_files(self, filenames):
+        """
+        Keep the files of this interval out of the local cache's
+        eviction until the interval is closed or garbage collected
+        """
+        if self._unpin is not None:
+            self._unpin()
+        self.dwnldr.local_cache.pin(filenames)
+        self._unpin = weakref.finalize(self, self.dwnldr.local_cache.unpin, filenames)
+
+    def close(self):
+        """Close the CDFs and let the local cache remove their files again"""
+        for cdf in self.cdfs:
+            cdf.close()
+        if self._unpin is not None:
+            self._unpin()
+
     def get_var_attr(self, var, att):
         """Get a variable attribute"""
         if var in self.computed:
@@ -134,34 +208,70 @@ class omni_interval(object):
         else:
             return None
 
+    def _read(self, cdfvar):
+        """
+        The records of cdfvar in the interval from all the files, fill values
+        made NaN. The records of an interval in one file are defilled in the
+        array read; those of several files are copied into one array allocated
+        up front and defilled where they land, so a long interval is never
+        held twice.
+        """
+        fillval = self.cdfs[-1][cdfvar].attrs['FILLVAL']
+        if len(self.cdfs) == 1:
+            data = self.cdfs[-1][cdfvar][self.si:self.ei]
+            self._defill(data, fillval, cdfvar)
+            return data
+        spans = []
+        for icdf, cdf in enumerate(self.cdfs):
+            start = self.si if icdf == 0 else None
+            stop = self.ei if icdf == len(self.cdfs) - 1 else None
+            start, stop, _ = slice(start, stop).indices(len(cdf[cdfvar]))
+            spans.append((start, max(stop, start)))
+        data = None
+        i = 0
+        defill = True
+        for cdf, (start, stop) in zip(self.cdfs, spans):
+            records = cdf[cdfvar][start:stop]
+            if data is None:
+                data = np.empty((sum(stop - start for start, stop in spans),) + records.shape[1:],
+                                dtype=records.dtype)
+            chunk = data[i:i + len(records)]
+            chunk[...] = records
+            del records
+            i += len(chunk)
+            if defill:
+                defill = self._defill(chunk, fillval, cdfvar)
+        return data
+
+    @staticmethod
+    def _defill(data, fillval, cdfvar):
+        """Make the fill values in data NaN in place, returning False if fillval can not be handled"""
+        try:
+            if np.isfinite(fillval):
+                filled = data == fillval
+                if np.count_nonzero(filled) > 0:
+                    data[filled] = np.nan
+        except:
+            print("Unhandled fill value %s for variable %s" % (fillval, cdfvar))
+            return False
+        return True
+
     def __getitem__(self, cdfvar):
+        """
+        The values of cdfvar in the interval. Arrays are kept (see
+        omni_result_cache) and returned read only, copy one to change it.
+        """
+        data = self.results.get(cdfvar)
+        if data is not None:
+            return data
         # If it's a derived variable go get it
         # with it's own __call__ method
         if cdfvar in self.computed:
             # print('1')
-            return self.computed[cdfvar]()
+            return self.results.put(cdfvar, self.computed[cdfvar]())
         # print(self.cdfs)
         # Attempt the getitem on all the cdfs in order
-        if len(self.cdfs) > 1:
-            ret = []
-            for icdf, cdf in enumerate(self.cdfs):
-                if icdf == 0:
-                    ret.append(cdf[cdfvar][self.si:])
-                elif icdf == len(self.cdfs) - 1:
-                    ret.append(cdf[cdfvar][:self.ei])
-                else:
-                    ret.append(cdf[cdfvar][:])
-            data = np.concatenate(ret)
-        else:
-            data = self.cdfs[-1][cdfvar][self.si:self.ei]
-        # Fix the fill values
-        try:
-            if np.isfinite(self.cdfs[-1][cdfvar].attrs['FILLVAL']):
-                filled = data == self.cdfs[-1][cdfvar].attrs['FILLVAL']
-                if np.count_nonzero(filled) > 0:
-                    data[filled] = np.nan
-        except:
-            print("Unhandled fill value %s for variable %s" % (self.cdfs[-1][cdfvar].attrs['FILLVAL'], cdfvar))
+        data = self._read(cdfvar)
         # Check for transforms which need to be performed
         if cdfvar in self.transforms:
             transform = self.transforms[cdfvar]
@@ -173,7 +283,7 @@ class omni_interval(object):
                 data = transform['fcn'](data)
                 # print "Data after", data
         # print('2')
-        return data
+        return self.results.put(cdfvar, data)
 
     def add_transform(self, cdfvar, cadences, fcn, desc):
         """
@@ -193,6 +303,7 @@ class omni_interval(object):
 
         """
         self.transforms[cdfvar] = {'cadences': cadences, 'fcn': fcn, 'desc': desc}
+        self.results.discard(cdfvar)
 
     def __str__(self):
         return 'oi '+str(self.cdfs[0])
\ No newline at end of file
@@ -0,0 +1,47 @@
+import collections
+import logging
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class omni_latency_tracker(object):
+    """
+    The last window times to first byte (seconds) of requests to one
+    backend, to tell how long a request usually takes to start answering
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.samples = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q, default=None):
+        """The q-th percentile of the recorded times, default while fewer than min_samples were recorded"""
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return default
+            return float(np.percentile(list(self.samples), q))
+
+
+_latency_trackers = dict()
+_latency_trackers_lock = threading.Lock()
+
+
+def get_latency_tracker(name):
+    """The latency tracker shared by everything in the process talking to the backend name"""
+    with _latency_trackers_lock:
+        if name not in _latency_trackers:
+            _latency_trackers[name] = omni_latency_tracker()
+        return _latency_trackers[name]
+
+
+def clear_latency_trackers():
+    with _latency_trackers_lock:
+        _latency_trackers.clear()
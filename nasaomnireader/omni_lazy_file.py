@@ -0,0 +1,64 @@
+import logging
+
+from nasaomnireader.omni_verify import record_spacing
+
+log = logging.getLogger(__name__)
+
+
+class omni_lazy_file(object):
+    """
+    One file of an omni_interval, opened (or parsed, for text files) by
+    dwnldr only when its variables are first read. OMNI files hold one
+    record every cadence from the start of the span they cover, so the
+    index of a time in the file is found without opening it.
+
+    A copy of the file fetched at or after fetched_since (e.g. by the
+    interval's prefetch) is opened without fetching it again.
+    """
+
+    def __init__(self, dwnldr, f, proxy_url=None, proxy_key=None, fetched_since=None):
+        self.dwnldr = dwnldr
+        self.f = f
+        self.fetched_since = fetched_since
+        self.proxy_url = proxy_url
+        self.proxy_key = proxy_key
+        self._cdf = None
+
+    @property
+    def is_open(self):
+        return self._cdf is not None
+
+    def open(self):
+        """The pycdf.CDF (or omni_txt_cdf_mimic) of the file, opened on first use"""
+        if self._cdf is None:
+            log.debug(f"Opening {self.f.filename}")
+            self._cdf = self.dwnldr.get_cdf_from_ya_disk(self.f.startdt, self.f.cadence, proxy_url=self.proxy_url,
+                                                         proxy_key=self.proxy_key,
+                                                         fetched_since=self.fetched_since)
+        return self._cdf
+
+    @property
+    def attrs(self):
+        return self.open().attrs
+
+    def __getitem__(self, var):
+        return self.open()[var]
+
+    def n_records(self):
+        """Number of records the file holds once complete"""
+        return (self.f.enddt - self.f.startdt) // record_spacing[self.f.cadence]
+
+    def index(self, dt):
+        """Index of the first record at or after dt, as np.searchsorted on the file's Epoch would give"""
+        # Rounded up, a time between two records starts at the later one
+        i = -((self.f.startdt - dt) // record_spacing[self.f.cadence])
+        return min(max(i, 0), self.n_records())
+
+    def close(self):
+        """Close the file if it was opened, it is opened again on next use"""
+        if self._cdf is not None:
+            self._cdf.close()
+            self._cdf = None
+
+    def __str__(self):
+        return str(self.open())
@@ -0,0 +1,102 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+listing_filename = 'omni_listing_cache.json'
+
+
+class omni_listing_cache(object):
+    """
+    Remembers the first and last available dates found by listing
+    a remote directory (NASA index page or Yandex Disk folder) for
+    each cadence, so that building many intervals does not list the
+    same directory again and again. Entries expire after ttl seconds.
+    If path is given the entries are also saved to (and loaded from)
+    that JSON file, so they outlive the process.
+    """
+
+    def __init__(self, ttl=3600., path=None):
+        self.ttl = ttl
+        self.path = path
+        self.entries = dict()  # key -> (min_date, max_date, time listed)
+        self._lock = threading.Lock()
+        if self.path is not None and os.path.exists(self.path):
+            self._load()
+
+    @staticmethod
+    def key(*parts):
+        """Key for a listing, e.g. key('yadisk', yd_dir, 'cdf', '5min')"""
+        return '|'.join(str(part) for part in parts)
+
+    def get(self, key, stale=False):
+        """
+        The (min_date, max_date) stored for key, or None if missing or
+        expired. With stale an expired entry is returned too (e.g. when
+        the directory can not be listed now).
+        """
+        with self._lock:
+            if key not in self.entries:
+                return None
+            min_date, max_date, listed_at = self.entries[key]
+            if time.time() - listed_at > self.ttl and not stale:
+                return None
+            return min_date, max_date
+
+    def put(self, key, min_date, max_date):
+        with self._lock:
+            self.entries[key] = (min_date, max_date, time.time())
+            if self.path is not None:
+                self._save()
+
+    def clear(self):
+        with self._lock:
+            self.entries = dict()
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            for key, (min_date, max_date, listed_at) in saved.items():
+                self.entries[key] = (datetime.datetime.fromisoformat(min_date),
+                                     datetime.datetime.fromisoformat(max_date),
+                                     listed_at)
+        except (ValueError, TypeError) as ex:
+            log.warning(f"Ignoring unreadable listing cache {self.path}: {str(ex)}")
+
+    def _save(self):
+        saved = {key: (min_date.isoformat(), max_date.isoformat(), listed_at)
+                 for key, (min_date, max_date, listed_at) in self.entries.items()}
+        tmpfn = self.path + '.tmp%d' % os.getpid()
+        with open(tmpfn, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmpfn, self.path)
+
+
+_shared_listing_cache = None
+_shared_listing_cache_lock = threading.Lock()
+
+
+def get_listing_cache():
+    """
+    The listing cache shared by all omni_downloader instances in this
+    process, configured from config['omnireader']
+    """
+    global _shared_listing_cache
+    with _shared_listing_cache_lock:
+        if _shared_listing_cache is None:
+            omni_config = config['omnireader']
+            path = None
+            if omni_config.get('listing_cache_on_disk', False):
+                path = os.path.join(omni_config['local_cdf_dir'], listing_filename)
+            _shared_listing_cache = omni_listing_cache(ttl=omni_config.get('listing_cache_ttl', 3600.),
+                                                       path=path)
+        return _shared_listing_cache
@@ -0,0 +1,96 @@
+import logging
+import os
+import threading
+import time
+
+from nasaomnireader.omni_cache_index import omni_cache_index
+
+log = logging.getLogger(__name__)
+
+
+class omni_local_cache(object):
+    """
+    Keeps the files in a local directory under a byte budget by
+    removing the least recently used ones. When each file was last
+    used is kept in the directory's omni_cache_index. Files in use
+    by open intervals can be pinned, and are never removed while pinned.
+    If max_bytes is None the directory is allowed to grow without limit.
+    """
+    _pins = dict()  # (localdir, file name) -> number of pins, shared by all instances
+    _pins_lock = threading.Lock()
+
+    def __init__(self, localdir, max_bytes=None, cache_index=None):
+        self.localdir = localdir
+        self.max_bytes = max_bytes
+        self.cache_index = omni_cache_index(localdir) if cache_index is None else cache_index
+        self._evict_lock = threading.Lock()
+
+    def touch(self, filename):
+        """Record that filename was just used"""
+        self.cache_index.put(filename, last_access=time.time())
+
+    def pin(self, filenames):
+        with omni_local_cache._pins_lock:
+            for filename in filenames:
+                key = (self.localdir, filename)
+                omni_local_cache._pins[key] = omni_local_cache._pins.get(key, 0) + 1
+
+    def unpin(self, filenames):
+        with omni_local_cache._pins_lock:
+            for filename in filenames:
+                key = (self.localdir, filename)
+                if key in omni_local_cache._pins:
+                    omni_local_cache._pins[key] -= 1
+                    if omni_local_cache._pins[key] <= 0:
+                        del omni_local_cache._pins[key]
+
+    def is_pinned(self, filename):
+        with omni_local_cache._pins_lock:
+            return (self.localdir, filename) in omni_local_cache._pins
+
+    def cached_files(self):
+        """The cached files in the directory with their sizes, from the cache index"""
+        return {filename: entry['size'] for filename, entry in self.cache_index.cached().items()
+                if entry['size'] is not None}
+
+    def evict(self):
+        """
+        Remove the least recently used unpinned files until the
+        directory fits in max_bytes. Returns the names of the removed files.
+        """
+        if self.max_bytes is None:
+            return []
+        with self._evict_lock:
+            sizes = self.cached_files()
+            total = sum(sizes.values())
+            if total <= self.max_bytes:
+                return []
+            indexed = self.cache_index.cached()
+
+            def last_access(filename):
+                # Files not used since they were indexed count as used when fetched
+                if indexed[filename]['last_access'] is not None:
+                    return indexed[filename]['last_access']
+                return indexed[filename]['fetched_at']
+
+            removed = []
+            for filename in sorted(sizes, key=last_access):
+                if total <= self.max_bytes:
+                    break
+                if self.is_pinned(filename):
+                    continue
+                try:
+                    os.remove(os.path.join(self.localdir, filename))
+                except FileNotFoundError:
+                    pass
+                except OSError as ex:
+                    log.warning(f"Could not remove {filename} from the local cache: {str(ex)}")
+                    continue
+                self.cache_index.remove(filename)
+                total -= sizes[filename]
+                removed.append(filename)
+            if total > self.max_bytes:
+                log.warning(f"Local cache {self.localdir} is {total} bytes, over its budget of {self.max_bytes}, "
+                            f"but the remaining files are pinned")
+            log.debug(f"Evicted {removed} from {self.localdir}")
+            return removed
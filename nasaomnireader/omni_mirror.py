@@ -0,0 +1,108 @@
+import argparse
+import datetime
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from nasaomnireader import config
+from nasaomnireader.omnireader import omni_downloader
+
+log = logging.getLogger(__name__)
+
+
+class omni_mirror(object):
+    """
+    Copies OMNI files from the NASA server to a Yandex Disk folder
+    for a range of dates and a list of cadences, on a bounded pool
+    of worker threads. Files already on Yandex Disk are skipped,
+    except for recent ones (ending less than refresh_recent_days ago)
+    which NASA may still be updating.
+    """
+
+    def __init__(self, yd_token, yd_dir, cdf_or_txt='cdf', max_workers=None, refresh_recent_days=62,
+                 proxy_url=None, proxy_key=None):
+        self.dwnldr = omni_downloader(yd_token, yd_dir, cdf_or_txt=cdf_or_txt)
+        if max_workers is None:
+            max_workers = config['omnireader'].get('mirror_workers', 4)
+        self.max_workers = max_workers
+        self.refresh_recent_days = refresh_recent_days
+        self.proxy_url = proxy_url
+        self.proxy_key = proxy_key
+
+    def _files_on_ya_disk(self):
+        """Names of the files already in the Yandex Disk folder"""
+        with self.dwnldr.yadisk_pool.client(self.dwnldr.yd_token) as y:
+            return set(file_inf.name for file_inf in y.listdir(self.dwnldr.yd_dir, fields=['name']))
+
+    def plan(self, startdt, enddt, cadences, now=None):
+        """
+        The files (omni_planned_file) for startdt to enddt at each of
+        cadences which are missing from Yandex Disk or may be stale
+        """
+        now = datetime.datetime.now() if now is None else now
+        recent = now - datetime.timedelta(days=self.refresh_recent_days)
+        on_ya_disk = self._files_on_ya_disk()
+        todo = []
+        for cadence in cadences:
+            for f in self.dwnldr.plan_files(startdt, enddt, cadence):
+                if f.startdt > now:
+                    # Not published yet
+                    continue
+                if f.filename not in on_ya_disk or f.enddt > recent:
+                    todo.append(f)
+        return todo
+
+    def run(self, startdt, enddt, cadences):
+        """
+        Copy the planned files to Yandex Disk. Returns a dict with
+        the names of the files that were 'uploaded' and 'skipped'
+        """
+        todo = self.plan(startdt, enddt, cadences)
+        log.info(f"Mirroring {len(todo)} files to {self.dwnldr.yd_dir} with {self.max_workers} workers")
+        result = {'uploaded': [], 'skipped': []}
+        if not todo:
+            return result
+
+        def copy(f):
+            return self.dwnldr.load_from_nasa_to_yadisk(f.startdt, f.cadence, self.proxy_url, self.proxy_key)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for f, uploaded in zip(todo, executor.map(copy, todo)):
+                result['uploaded' if uploaded else 'skipped'].append(f.filename)
+        if result['uploaded']:
+            # The first and last available dates may have changed
+            self.dwnldr.listing_cache.clear()
+        return result
+
+
+def _parse_date(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copy OMNI files from NASA to a Yandex Disk folder')
+    parser.add_argument('startdate', type=_parse_date, help='First date to copy, YYYY-MM-DD')
+    parser.add_argument('enddate', type=_parse_date, help='Last date to copy, YYYY-MM-DD')
+    parser.add_argument('--cadence', action='append', choices=['hourly', '5min', '1min'],
+                        help='Cadence to copy (can be given more than once, default all)')
+    parser.add_argument('--token', required=True, help='Yandex Disk OAuth token')
+    parser.add_argument('--dir', required=True, help='Yandex Disk folder')
+    parser.add_argument('--format', default='cdf', choices=['cdf', 'txt'])
+    parser.add_argument('--workers', type=int, default=None, help='Files copied at the same time')
+    parser.add_argument('--proxy-url', default=None)
+    parser.add_argument('--proxy-key', default=None)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    mirror = omni_mirror(args.token, args.dir, cdf_or_txt=args.format, max_workers=args.workers,
+                         proxy_url=args.proxy_url, proxy_key=args.proxy_key)
+    cadences = args.cadence if args.cadence is not None else ['hourly', '5min', '1min']
+    result = mirror.run(args.startdate, args.enddate, cadences)
+    print('Uploaded %d files, skipped %d' % (len(result['uploaded']), len(result['skipped'])))
+    for fn in result['skipped']:
+        print('Skipped %s' % fn)
+    return 0 if not result['skipped'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
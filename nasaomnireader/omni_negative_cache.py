@@ -0,0 +1,71 @@
+import datetime
+import logging
+import threading
+import time
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+
+class omni_negative_cache(object):
+    """
+    Remembers which files a backend did not have, keyed by
+    (backend, cadence, file name), so asking again for a month which
+    is not published (or has no data) fails at once instead of costing
+    a request. Entries expire after ttl seconds, or recent_ttl seconds
+    for files ending less than recent_days ago, which may appear soon.
+    """
+
+    def __init__(self, ttl=86400., recent_ttl=3600., recent_days=62):
+        self.ttl = ttl
+        self.recent_ttl = recent_ttl
+        self.recent_days = recent_days
+        self.entries = dict()  # key -> time the entry expires
+        self._lock = threading.Lock()
+
+    def add(self, backend, f, now=None):
+        """Record that backend does not have the planned file f"""
+        now = datetime.datetime.now() if now is None else now
+        recent = f.enddt > now - datetime.timedelta(days=self.recent_days)
+        with self._lock:
+            self.entries[(backend, f.cadence, f.filename)] = time.time() + (self.recent_ttl if recent else self.ttl)
+
+    def is_missing(self, backend, f):
+        """Whether backend did not have the planned file f when last asked (and the entry has not expired)"""
+        key = (backend, f.cadence, f.filename)
+        with self._lock:
+            if key not in self.entries:
+                return False
+            if time.time() > self.entries[key]:
+                del self.entries[key]
+                return False
+            return True
+
+    def discard(self, backend, f):
+        with self._lock:
+            self.entries.pop((backend, f.cadence, f.filename), None)
+
+    def clear(self):
+        with self._lock:
+            self.entries = dict()
+
+
+_shared_negative_cache = None
+_shared_negative_cache_lock = threading.Lock()
+
+
+def get_negative_cache():
+    """
+    The negative cache shared by all omni_downloader instances in this
+    process, configured from config['omnireader']
+    """
+    global _shared_negative_cache
+    with _shared_negative_cache_lock:
+        if _shared_negative_cache is None:
+            omni_config = config['omnireader']
+            _shared_negative_cache = omni_negative_cache(
+                ttl=omni_config.get('negative_cache_ttl', 86400.),
+                recent_ttl=omni_config.get('negative_cache_recent_ttl', 3600.),
+                recent_days=omni_config.get('negative_cache_recent_days', 62))
+        return _shared_negative_cache
@@ -0,0 +1,181 @@
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+# Requests at once at most to each server, adapting to the server pushing back (servers not listed: no limit)
+default_max_concurrent = config['omnireader'].get('max_concurrent', {'nasa': 4, 'proxy': 4})
+
+
+class RetryableError(RuntimeError):
+    """
+    A server asked us to slow down or was briefly unavailable.
+    retry_after is the seconds it asked us to wait, or None.
+    """
+
+    def __init__(self, msg='', retry_after=None):
+        super(RetryableError, self).__init__(msg)
+        self.retry_after = retry_after
+
+
+class ToManyRequestsError(RetryableError):
+    """The server answered 429 Too Many Requests"""
+
+
+class ServerUnavailableError(RetryableError):
+    """The server answered with a 5xx code"""
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or HTTP date), None if missing or unreadable"""
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0., (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class omni_rate_limiter(object):
+    """
+    Paces the requests sent to one backend. Each request takes a token
+    from a bucket refilled at rate tokens per second (holding at most
+    burst tokens, rate None for no limit), and at most concurrency
+    requests run at the same time. call() retries requests which fail
+    with a RetryableError, waiting the server's Retry-After or an
+    exponential backoff with jitter, up to retries times.
+
+    Concurrency adapts: it is halved each time the server pushes back
+    and grows by one after as many successes in a row, up to max_concurrent
+    (None for no limit, in which case it does not adapt).
+    """
+
+    def __init__(self, rate=None, burst=4, max_concurrent=None, retries=5, backoff_base=.5, backoff_max=60.):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.concurrency = max_concurrent
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tokens = float(burst)
+        self.active = 0
+        self._successes = 0
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.
+        self._condition = threading.Condition()
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number attempt (from 0), with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _wait_time(self):
+        """Seconds until a request may start, 0 if one may start now (call holding the condition)"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.concurrency is not None and self.active >= self.concurrency:
+            return None  # Until a running request finishes
+        if self.rate is None:
+            return 0.
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self.tokens >= 1.:
+            return 0.
+        return (1. - self.tokens) / self.rate
+
+    def _start(self):
+        with self._condition:
+            while True:
+                wait = self._wait_time()
+                if wait == 0.:
+                    break
+                self._condition.wait(wait)
+            if self.rate is not None:
+                self.tokens -= 1.
+            self.active += 1
+
+    def _finish(self, throttled_for=None):
+        with self._condition:
+            self.active -= 1
+            if throttled_for is not None:
+                self._paused_until = max(self._paused_until, time.monotonic() + throttled_for)
+                self._successes = 0
+                if self.concurrency is not None and self.concurrency > 1:
+                    self.concurrency //= 2
+                    log.debug(f"Throttled, concurrency down to {self.concurrency}")
+            elif self.concurrency is not None and self.concurrency < self.max_concurrent:
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self._successes = 0
+                    self.concurrency += 1
+            self._condition.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        """func(*args, **kwargs), paced and retried while it raises a RetryableError"""
+        for attempt in range(self.retries + 1):
+            self._start()
+            try:
+                result = func(*args, **kwargs)
+            except RetryableError as ex:
+                if attempt == self.retries:
+                    self._finish()
+                    raise
+                delay = ex.retry_after if ex.retry_after is not None else self.backoff(attempt)
+                # A little jitter, so that waiting threads do not all come back at once
+                delay += random.uniform(0, self.backoff_base)
+                log.warning(f"{str(ex)}, retry {attempt + 1} of {self.retries} in {delay:.1f} seconds")
+                # Every request to the backend (this retry included) waits out the delay
+                self._finish(throttled_for=delay)
+                continue
+            except BaseException:
+                self._finish()
+                raise
+            self._finish()
+            return result
+
+
+_rate_limiters = dict()
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name, **kwargs):
+    """
+    The rate limiter shared by everything in the process talking to the
+    backend name (e.g. 'nasa', 'proxy' or 'yadisk'). It is created on
+    first use from config['omnireader'], with kwargs overriding it.
+    Raises ValueError if kwargs differ from the settings it was created with.
+    """
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            omni_config = config['omnireader']
+            settings = {'rate': omni_config.get('request_rate', None),
+                        'burst': omni_config.get('request_burst', 4),
+                        'max_concurrent': default_max_concurrent.get(name),
+                        'retries': omni_config.get('throttle_retries', 5),
+                        'backoff_max': omni_config.get('backoff_max', 60.)}
+            settings.update(kwargs)
+            _rate_limiters[name] = omni_rate_limiter(**settings)
+        limiter = _rate_limiters[name]
+        for key, value in kwargs.items():
+            if getattr(limiter, key) != value:
+                raise ValueError(f"The rate limiter of {name} has {key}={getattr(limiter, key)}, "
+                                 f"it can not also have {key}={value}")
+        return limiter
+
+
+def clear_rate_limiters():
+    """Forget the shared rate limiters (e.g. after the config changed)"""
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
@@ -0,0 +1,110 @@
+import logging
+import os
+import queue
+import threading
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+
+class omni_readahead(object):
+    """
+    Fetches files expected to be needed soon (e.g. the next months of a
+    month by month scan) on background threads, so the download overlaps
+    with work on the current file. At most max_bytes of read-ahead files
+    (None for no limit) may be waiting to be used at a time. The threads
+    are daemons, so a job which ends does not wait for them; a fetch cut
+    short leaves no partial file in the cache.
+    """
+
+    def __init__(self, workers=2, max_bytes=None):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.pending = dict()  # localfn -> bytes (estimated until fetched) of files read ahead and not used yet
+        self._fetching = set()  # localfn of the files scheduled and not fetched yet
+        self.queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def schedule(self, dwnldr, f, estimate):
+        """
+        Fetch the planned file f with dwnldr in the background, unless it
+        is already scheduled or estimate more bytes would be over budget.
+        Returns True if it was scheduled.
+        """
+        with self._lock:
+            # Forget the files read ahead and then removed from the cache without being used
+            for localfn in [localfn for localfn in self.pending
+                            if localfn not in self._fetching and not os.path.exists(localfn)]:
+                del self.pending[localfn]
+            if f.localfn in self.pending:
+                return False
+            if self.max_bytes is not None and sum(self.pending.values()) + estimate > self.max_bytes:
+                log.debug(f"Not reading {f.filename} ahead, over the budget of {self.max_bytes} bytes")
+                return False
+            self.pending[f.localfn] = estimate
+            self._fetching.add(f.localfn)
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self.queue.put((dwnldr, f))
+        return True
+
+    def used(self, localfn):
+        """Record that a file was used, so it no longer counts against the budget"""
+        with self._lock:
+            self.pending.pop(localfn, None)
+
+    def _work(self):
+        while True:
+            dwnldr, f = self.queue.get()
+            try:
+                dwnldr.fetch_file(f.startdt, f.cadence)
+                with self._lock:
+                    if f.localfn in self.pending:
+                        self.pending[f.localfn] = os.path.getsize(f.localfn)
+                log.debug(f"Read {f.filename} ahead")
+            except Exception as ex:
+                if isinstance(ex, (OSError, RuntimeError)):
+                    log.debug(f"Could not read {f.filename} ahead: {str(ex)}")
+                else:
+                    # Not expected, but it must not stop the thread
+                    log.exception(f"Could not read {f.filename} ahead")
+                with self._lock:
+                    self.pending.pop(f.localfn, None)
+            finally:
+                with self._lock:
+                    self._fetching.discard(f.localfn)
+                self.queue.task_done()
+
+    def wait(self):
+        """Wait until every scheduled file has been fetched (or failed)"""
+        self.queue.join()
+
+    def clear(self):
+        """Wait for the scheduled files and forget them"""
+        self.wait()
+        with self._lock:
+            self.pending = dict()
+            self._fetching = set()
+
+
+_shared_readahead = None
+_shared_readahead_lock = threading.Lock()
+
+
+def get_readahead():
+    """
+    The read-ahead threads shared by all omni_downloader instances in
+    this process, configured from config['omnireader']
+    """
+    global _shared_readahead
+    with _shared_readahead_lock:
+        if _shared_readahead is None:
+            omni_config = config['omnireader']
+            _shared_readahead = omni_readahead(workers=omni_config.get('readahead_workers', 2),
+                                               max_bytes=omni_config.get('readahead_max_bytes', 256 * 1024 * 1024))
+        return _shared_readahead
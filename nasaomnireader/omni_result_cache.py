@@ -0,0 +1,70 @@
+import collections
+import logging
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Object arrays (e.g. Epoch as datetimes) hold pointers, count the objects too
+object_item_bytes = 64
+
+
+def result_bytes(data):
+    """Bytes of memory held by the array data, roughly for object arrays"""
+    if data.dtype == object:
+        return data.size * object_item_bytes
+    return data.nbytes
+
+
+class omni_result_cache(object):
+    """
+    The finished arrays of an omni_interval's variables, keyed by name,
+    keeping at most max_bytes (None for no limit) by forgetting the least
+    recently used. Cached arrays are made read only, so a caller changing
+    one in place gets an error instead of changing what later callers see.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.results = collections.OrderedDict()  # name -> array, least recently used first
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """The cached array for name, None if it is not cached"""
+        with self._lock:
+            data = self.results.get(name)
+            if data is not None:
+                self.results.move_to_end(name)
+            return data
+
+    def put(self, name, data):
+        """Cache the array data for name (unless it is larger than max_bytes), returning it read only"""
+        data = np.asarray(data)
+        data.flags.writeable = False
+        nbytes = result_bytes(data)
+        with self._lock:
+            self._discard(name)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                log.debug(f"{name} ({nbytes} bytes) is larger than the result cache, not cached")
+                return data
+            self.results[name] = data
+            self.total_bytes += nbytes
+            while self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                oldest, oldest_data = self.results.popitem(last=False)
+                self.total_bytes -= result_bytes(oldest_data)
+        return data
+
+    def _discard(self, name):
+        if name in self.results:
+            self.total_bytes -= result_bytes(self.results.pop(name))
+
+    def discard(self, name):
+        with self._lock:
+            self._discard(name)
+
+    def clear(self):
+        with self._lock:
+            self.results = collections.OrderedDict()
+            self.total_bytes = 0
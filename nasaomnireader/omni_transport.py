@@ -0,0 +1,68 @@
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+
+class omni_transport(object):
+    """
+    Pooled, keep-alive HTTP transport. Keeps one requests.Session
+    per host, so that directory listings and file downloads reuse
+    open TCP/TLS connections instead of paying a new handshake
+    for every request.
+    """
+
+    def __init__(self, pool_size=10, proxy_timeout=62.75, direct_timeout=32.75):
+        self.pool_size = pool_size  # Connections kept open per host
+        self.proxy_timeout = proxy_timeout  # Seconds to wait on the proxy
+        self.direct_timeout = direct_timeout  # Seconds to wait on the NASA server
+        self.sessions = dict()
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """Get (creating if needed) the session for the host of url"""
+        parsed = urlparse(url)
+        host = parsed.scheme + '://' + parsed.netloc
+        with self._lock:
+            if host not in self.sessions:
+                log.debug('New HTTP session for %s, pool size %d' % (host, self.pool_size))
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(host, adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def get(self, url, timeout, **kwargs):
+        return self.session(url).get(url, timeout=timeout, **kwargs)
+
+    def close(self):
+        """Close all the sessions (and their pooled connections)"""
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = dict()
+
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    The transport shared by all omni_downloader instances in this
+    process, configured from config['omnireader']
+    """
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            omni_config = config['omnireader']
+            _shared_transport = omni_transport(pool_size=omni_config.get('http_pool_size', 10),
+                                               proxy_timeout=omni_config.get('proxy_timeout', 62.75),
+                                               direct_timeout=omni_config.get('nasa_timeout', 32.75))
+        return _shared_transport
@@ -1,3 +1,4 @@
+import io
 import logging
 
 import numpy as np
@@ -6,6 +7,7 @@ import pandas as pd
 from geospacepy import special_datetime
 
 from nasaomnireader import omnitxtcdf
+from nasaomnireader.omni_compression import open_file
 from nasaomnireader.omni_txt_cdf_mimic_var import omni_txt_cdf_mimic_var
 
 log = logging.getLogger(__name__)
@@ -24,21 +26,43 @@ class omni_txt_cdf_mimic(object):
         self.cadence = cadence
         try:
             # self.data_old = np.genfromtxt(omnitxt)
-            self.data = pd.read_csv(omnitxt, sep='\s+').to_numpy()
+            # Compressed files are decompressed as they are read
+            with open_file(omnitxt) as f:
+                self.data = pd.read_csv(f, sep='\s+', header=None).to_numpy()
         except Exception as ex:
             log.error(str(ex))
             print(f"Reading from {omnitxt} error = {ex}")
             raise ex
+        self._make_vars()
 
+    def extend(self, offset):
+        """
+        Read the lines appended to the text file from byte offset on (by
+        omni_downloader.refresh_tail) and add them to the variables, without
+        reading the start of the file again. In a compressed file offset is
+        where the appended member starts.
+        """
+        with open_file(self.txtfn, offset) as f:
+            tail = f.read()
+        if not tail.strip():
+            return 0
+        new_data = pd.read_csv(io.BytesIO(tail), sep='\s+', header=None).to_numpy()
+        self.data = np.concatenate([self.data, new_data])
+        self._make_vars()
+        return len(new_data)
+
+    def _make_vars(self):
         # Load the dictionaries that map CDF variable names in
         # the omni CDFs to columns in the text files
+        cadence = self.cadence
         cdfvars_meta = omnitxtcdf.metadata[cadence]['vars']
         self.vars = {varname: omni_txt_cdf_mimic_var(varname, cdfvars_meta[varname], self.data, cadence) for varname in
                      cdfvars_meta}
         self.attrs = omnitxtcdf.metadata[cadence]['attrs']
         # Compute the equivalent to the CDF variable'Epoch', i.e. the time
         # of each observation as an array of datetimes
-        year, doy = self.vars['YR'][:], self.vars['Day'][:]
+        # (a copy, the day column itself must stay as it is in the file for extend)
+        year, doy = self.vars['YR'][:], self.vars['Day'][:].astype(float)
         if 'HR' in self.vars:
             doy += self.vars['HR'][:] / 24.
         if 'Minute' in self.vars:
@@ -47,6 +71,10 @@ class omni_txt_cdf_mimic(object):
         epoch = special_datetime.doyarr2datetime(doy, year).flatten()
         self.vars['Epoch'] = omni_txt_cdf_mimic_var('Epoch', epoch_vardict, epoch, cadence, data_is_column=True)
 
+    def close(self):
+        """Nothing to close, the text file is read in full when opened"""
+        pass
+
     def __getitem__(self, var):
         try:
             data = self.vars[var]
@@ -81,6 +81,9 @@ class omni_txt_cdf_mimic_var(object):
             vardata[probably_fill] = np.nan
         return vardata
 
+    def __len__(self):
+        return len(self.data)
+
     def __getitem__(self, *args):
         vardata = self.data.__getitem__(*args)
         return self._nan_fill_datapoints(vardata)
\ No newline at end of file
@@ -0,0 +1,103 @@
+import datetime
+import logging
+import threading
+
+from nasaomnireader.omni_compression import open_file, decompression_errors
+
+log = logging.getLogger(__name__)
+
+try:
+    from spacepy import pycdf
+except ImportError:
+    pycdf = None
+
+# First four bytes of a CDF: version 3, version 2.6 and older version 2 files
+cdf_magic_numbers = [b'\xcd\xf3\x00\x01', b'\xcd\xf2\x60\x02', b'\x00\x00\xff\xff']
+
+record_spacing = {'1min': datetime.timedelta(minutes=1),
+                  '5min': datetime.timedelta(minutes=5),
+                  'hourly': datetime.timedelta(hours=1)}
+
+# Words on each line of the text files. omnitxtcdf.metadata can not tell,
+# it leaves out columns (e.g. the 5 minute proton fluxes) it does not read.
+line_columns = {'1min': 46,
+                '5min': 49,
+                'hourly': 55}
+
+
+class CorruptFileError(RuntimeError):
+    """A downloaded file is not a valid OMNI file (truncated, an error page...)"""
+
+
+def verify_file(path, cdf_or_txt, cadence, startdt=None, enddt=None):
+    """
+    Check that path holds a whole OMNI file of cadence, raising
+    CorruptFileError if not. CDFs must start with the CDF magic number
+    and (if spacepy is available) have records, all with an Epoch in
+    startdt to enddt when given. Text files must have lines of one
+    length, each with the number of columns line_columns gives for
+    cadence, the last ending with a newline. Neither may have more
+    records than cadence fits in startdt to enddt.
+
+    The CDF library can not be used by several threads at once, so away
+    from the main thread only the magic number of a CDF is checked.
+    Returns whether the file was checked in full.
+    """
+    max_records = None
+    if startdt is not None and enddt is not None:
+        max_records = (enddt - startdt) // record_spacing[cadence]
+    if cdf_or_txt == 'cdf':
+        n_records = _verify_cdf(path, startdt, enddt)
+    else:
+        n_records = _verify_txt(path, cadence)
+    if max_records is not None and n_records is not None and n_records > max_records:
+        raise CorruptFileError(f"{path} has {n_records} records, {cadence} files from {startdt} "
+                               f"to {enddt} have at most {max_records}")
+    return n_records is not None or pycdf is None
+
+
+def _verify_cdf(path, startdt, enddt):
+    """Check a CDF, returning its number of records (None if it could not be opened here)"""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic not in cdf_magic_numbers:
+        raise CorruptFileError(f"{path} does not start with a CDF magic number ({magic!r})")
+    if pycdf is None or threading.current_thread() is not threading.main_thread():
+        return None
+    try:
+        with pycdf.CDF(path) as cdf:
+            epoch = cdf['Epoch'][:]
+    except Exception as ex:
+        raise CorruptFileError(f"{path} can not be read as a CDF: {str(ex)}")
+    if len(epoch) == 0:
+        raise CorruptFileError(f"{path} has no records")
+    if startdt is not None and epoch[0] < startdt or enddt is not None and epoch[-1] >= enddt:
+        raise CorruptFileError(f"{path} has records from {epoch[0]} to {epoch[-1]}, "
+                               f"outside of {startdt} to {enddt}")
+    return len(epoch)
+
+
+def _verify_txt(path, cadence):
+    """Check a text file, returning its number of lines"""
+    columns = line_columns[cadence]
+    line_length = None
+    n_lines = 0
+    try:
+        with open_file(path) as f:
+            for line in f:
+                n_lines += 1
+                if not line.endswith(b'\n'):
+                    raise CorruptFileError(f"{path} line {n_lines} is cut short")
+                if line_length is None:
+                    line_length = len(line)
+                elif len(line) != line_length:
+                    raise CorruptFileError(f"{path} line {n_lines} is {len(line)} bytes long, "
+                                           f"the first is {line_length}")
+                if len(line.split()) != columns:
+                    raise CorruptFileError(f"{path} line {n_lines} has {len(line.split())} columns, "
+                                           f"{cadence} files have {columns}")
+    except decompression_errors as ex:
+        raise CorruptFileError(f"{path} can not be decompressed after line {n_lines}: {str(ex)}")
+    if n_lines == 0:
+        raise CorruptFileError(f"{path} is empty")
+    return n_lines
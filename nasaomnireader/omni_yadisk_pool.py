@@ -0,0 +1,67 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import yadisk as yadisk
+
+from nasaomnireader import config
+
+log = logging.getLogger(__name__)
+
+
+class omni_yadisk_pool(object):
+    """
+    Yandex Disk clients shared by everything in the process, one per
+    token. A client keeps its HTTP sessions (and so its connections)
+    open between calls, so reusing it avoids a new handshake for every
+    listing, download and upload. The number of operations running at
+    the same time with one token is limited to max_concurrent.
+    """
+
+    def __init__(self, max_concurrent=4):
+        self.max_concurrent = max_concurrent
+        self.clients = dict()  # token -> yadisk.YaDisk
+        self.semaphores = dict()  # token -> threading.BoundedSemaphore
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self, token):
+        """
+        Use the client for token, waiting first if max_concurrent
+        operations are already running with it
+        """
+        with self._lock:
+            if token not in self.clients:
+                self.clients[token] = yadisk.YaDisk(token=token)
+                self.semaphores[token] = threading.BoundedSemaphore(self.max_concurrent)
+            client, semaphore = self.clients[token], self.semaphores[token]
+        with semaphore:
+            yield client
+
+    def close(self):
+        """Close all the clients (and their connections)"""
+        with self._lock:
+            for client in self.clients.values():
+                try:
+                    client.close()
+                except Exception as ex:
+                    log.warning(f"Error closing Yandex Disk client: {str(ex)}")
+            self.clients = dict()
+            self.semaphores = dict()
+
+
+_shared_yadisk_pool = None
+_shared_yadisk_pool_lock = threading.Lock()
+
+
+def get_yadisk_pool():
+    """
+    The Yandex Disk client pool shared by all omni_downloader instances
+    in this process, configured from config['omnireader']
+    """
+    global _shared_yadisk_pool
+    with _shared_yadisk_pool_lock:
+        if _shared_yadisk_pool is None:
+            _shared_yadisk_pool = omni_yadisk_pool(
+                max_concurrent=config['omnireader'].get('yadisk_max_concurrent', 4))
+        return _shared_yadisk_pool
@@ -1,17 +1,38 @@
 # (C) 2020 University of Colorado AES-CCAR-SEDA (Space Environment Data Analysis) Group
 # Written by Liam M. Kilcommons
+import collections
 import datetime
+import hashlib
 import logging
 import os
 import requests
+import shutil
+import tempfile
 import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import yadisk as yadisk
 from requests import ReadTimeout
 import re
 import calendar
 
+from nasaomnireader.omni_backends import build_tiers, omni_yadisk_backend, DownloadCancelledError
+from nasaomnireader.omni_cache_index import omni_cache_index
+from nasaomnireader.omni_circuit_breaker import get_circuit_breaker
+from nasaomnireader.omni_compression import (append_file, check_compression, compress_file, content_stat, content_tail,
+                                             is_compressed)
+from nasaomnireader.omni_file_lock import omni_file_lock
+from nasaomnireader.omni_listing_cache import omni_listing_cache, get_listing_cache
+from nasaomnireader.omni_local_cache import omni_local_cache
+from nasaomnireader.omni_negative_cache import get_negative_cache
+from nasaomnireader.omni_readahead import get_readahead
+from nasaomnireader.omni_rate_limiter import (get_rate_limiter, parse_retry_after, ToManyRequestsError,
+                                              ServerUnavailableError)
+from nasaomnireader.omni_transport import get_transport
+from nasaomnireader.omni_verify import verify_file, CorruptFileError
 from nasaomnireader.omni_txt_cdf_mimic import omni_txt_cdf_mimic
+from nasaomnireader.omni_yadisk_pool import get_yadisk_pool
 
 log = logging.getLogger(__name__)
 
@@ -146,17 +167,76 @@ except ImportError:
 from nasaomnireader import config
 
 localdir = config['omnireader']['local_cdf_dir']
+# Number of files fetched at the same time when prefetching an interval
+prefetch_workers = config['omnireader'].get('prefetch_workers', 4)
+# Bytes held in memory at a time while streaming a download to disk
+# (also how much of a broken download may have to be fetched again)
+download_chunk_size = config['omnireader'].get('download_chunk_size', 64 * 1024)
+# Times a download which fails part way through is resumed before giving up
+download_retries = config['omnireader'].get('download_retries', 3)
+# Bytes of files kept in localdir before the least recently used are removed (None for no limit)
+local_cache_max_bytes = config['omnireader'].get('local_cache_max_bytes', None)
+# Use only the files already in localdir, never the network
+work_offline = config['omnireader'].get('offline', False)
+# Files after the one asked for fetched in the background (0 for none)
+readahead_files = config['omnireader'].get('readahead_files', 0)
+# Where corrupt files are moved to (None for a 'quarantine' directory in localdir)
+quarantine_dir = config['omnireader'].get('quarantine_dir', None)
+# Times a file which arrived corrupt is fetched again from the same place
+corrupt_retries = config['omnireader'].get('corrupt_retries', 1)
+# Compression ('gzip' or 'zstd', None for none) of cached text files and of uploads to Yandex Disk
+text_compression = config['omnireader'].get('compression', None)
 
 
-class ToManyRequestsError(RuntimeError):
-    ...
+# One file needed for an interval: the span of time it covers (startdt
+# inclusive, enddt exclusive), its name on Yandex Disk and in localdir,
+# its path on the NASA server and its path in localdir
+omni_planned_file = collections.namedtuple('omni_planned_file',
+                                           ['startdt', 'enddt', 'cadence', 'filename', 'remotefn', 'localfn',
+                                            'cached'])
+# (localdir, cdf_or_txt) already checked for files cached before they were indexed
+_indexed_localdirs = set()
+_indexed_localdirs_lock = threading.Lock()
+
+
+def file_md5(path):
+    """md5 hex digest of a file, read a chunk at a time"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class OfflineCacheMissError(RuntimeError):
+    """Something not in localdir was needed while working offline"""
 
 
 class omni_downloader(object):
-    def __init__(self, yd_token, yd_dir, cdf_or_txt='cdf', force_download=False):
+    def __init__(self, yd_token, yd_dir, cdf_or_txt='cdf', force_download=False, transport=None, revalidate=False,
+                 offline=None, tiers=None, proxy_url=None, proxy_key=None, readahead=None, compression=None):
         self.localdir = localdir
+        # Answer only from the files in localdir, without any network client
+        self.offline = work_offline if offline is None else offline
+        if self.offline and (force_download or revalidate):
+            raise ValueError('force_download and revalidate need the network, they can not be used offline')
+        # Validators (ETag, Last-Modified, size) of the cached files
+        self.cache_index = omni_cache_index(self.localdir)
+        # Keeps localdir under its byte budget
+        self.local_cache = omni_local_cache(self.localdir, max_bytes=local_cache_max_bytes,
+                                            cache_index=self.cache_index)
+        # HTTP sessions are shared by all downloaders unless one is passed in
+        self.transport = get_transport() if transport is None else transport
+        # So are the first and last available dates found by listing remote directories
+        self.listing_cache = get_listing_cache()
+        # and the Yandex Disk clients
+        self.yadisk_pool = get_yadisk_pool()
+        # and which files each backend did not have
+        self.negative_cache = get_negative_cache()
         self.cdf_or_txt = cdf_or_txt if spacepy_is_available else 'txt'  # is set at top of file in imports
         self.force_download = force_download
+        # Check cached files with a conditional request, downloading only if they changed
+        self.revalidate = revalidate
         self.ftpserv = 'spdf.gsfc.nasa.gov'
         self.ftpdir = '/pub/data/omni'
 
@@ -205,6 +285,13 @@ class omni_downloader(object):
                 '5min': 'omni_hro_5min_%Y%m01_v01.cdf',
                 '1min': 'omni_hro_1min_%Y%m01_v01.cdf'
             }
+
+            # Number of months covered by one file
+            self.file_months = {
+                'hourly': 6,
+                '5min': 1,
+                '1min': 1
+            }
         elif self.cdf_or_txt == 'txt':
             self.cadence_subdir = {
                 'hourly': 'low_res_omni',
@@ -242,27 +329,69 @@ class omni_downloader(object):
                 '1min': 'omni_min%Y%m.asc'
             }
 
+            # Number of months covered by one file
+            self.file_months = {
+                'hourly': 12,
+                '5min': 12,
+                '1min': 1
+            }
+
         else:
             raise ValueError('Invalid value of cdf_or_txt argument. Valid values are "txt" and "cdf"')
 
-    def get_response(self, url, proxy_url, proxy_key):
+        # Number of files after each one opened to fetch in the background
+        self.readahead = readahead_files if readahead is None else readahead
+        self.readahead_threads = get_readahead()
+
+        # Text files are compressed in place (keeping their names) once fetched,
+        # CDFs are left alone as they have their own compression
+        self.compression = text_compression if compression is None else compression or None
+        check_compression(self.compression)
+        if self.cdf_or_txt == 'cdf':
+            self.compression = None
+
+        # Backends (omni_backend) tried in order for files missing from localdir,
+        # from config['omnireader']['tiers'] unless given
+        if self.offline:
+            self.tiers = []
+        elif tiers is None:
+            self.tiers = build_tiers(self, proxy_url=proxy_url, proxy_key=proxy_key)
+        else:
+            self.tiers = tiers
+
+        with _indexed_localdirs_lock:
+            if (self.localdir, self.cdf_or_txt) not in _indexed_localdirs:
+                self._index_untracked_files()
+                _indexed_localdirs.add((self.localdir, self.cdf_or_txt))
+
+    def _require_online(self, what):
+        if self.offline:
+            raise OfflineCacheMissError(f"Working offline, can not {what}")
+
+    def get_response(self, url, proxy_url, proxy_key, stream=False, headers=None, timeout=None):
+        self._require_online(f"get {url}")
         response = None
+        extra_headers = dict() if headers is None else headers
         if proxy_url is not None and proxy_key is not None:
             api_key = proxy_key
             headers = {
                 "apikey": api_key
             }
+            headers.update(extra_headers)
             params = [("url", url)]
 
             # log.debug("try get response content with proxy")
-            get_timeout = 62.75
+            get_timeout = self.transport.proxy_timeout if timeout is None else timeout
             try:
-                response = requests.get(proxy_url, headers=headers, params=params, timeout=get_timeout)
+                response = self.transport.get(proxy_url, get_timeout, headers=headers, params=params,
+                                              stream=stream)
                 # print(response.status_code)
 
-                if response.status_code >= 400:
-                    if response.status_code == 429:
-                        raise ToManyRequestsError('Слишком много запросов к proxy')
+                self._raise_if_throttled(url, response)
+                if response.status_code == 404:
+                    raise FileNotFoundError(f"{url} not found")
+                # A 416 answer to a Range request is handled by download_to_file
+                if response.status_code >= 400 and not (response.status_code == 416 and 'Range' in extra_headers):
                     raise RuntimeError(
                         f"{url} Ошибка запроса - ответ пришел с кодом {response.status_code}. {response.content}")
             except ReadTimeout as e:
@@ -273,20 +402,177 @@ class omni_downloader(object):
 
         else:
             # log.debug("try get response content without proxy")
-            get_timeout = 32.75
+            get_timeout = self.transport.direct_timeout if timeout is None else timeout
             try:
-                response = requests.get(url, timeout=get_timeout)
+                response = self.transport.get(url, get_timeout, stream=stream, headers=extra_headers)
                 # print(response.status_code)
+                self._raise_if_throttled(url, response)
             except ReadTimeout as e:
                 msg = f"TimeOut {str(e)} then try to get data from NASA server in {get_timeout} seconds"
                 log.error(msg)
                 raise RuntimeError(msg)
         return response
 
-    def fix_interval(self, start_dt, end_dt, cadence, proxy_url=None, proxy_key=None):
+    @staticmethod
+    def _raise_if_throttled(url, response):
+        """Raise a RetryableError (with the server's Retry-After) for 429 and 5xx answers"""
+        if response.status_code != 429 and response.status_code < 500:
+            return
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        response.close()
+        if response.status_code == 429:
+            raise ToManyRequestsError(f'Слишком много запросов, {url}', retry_after=retry_after)
+        raise ServerUnavailableError(f"{url} Ошибка сервера - ответ пришел с кодом {response.status_code}",
+                                     retry_after=retry_after)
+
+    @staticmethod
+    def _http_source(proxy_url, proxy_key):
+        """Name of the server a request goes to, 'proxy' or 'nasa'"""
+        return 'proxy' if proxy_url is not None and proxy_key is not None else 'nasa'
+
+    @staticmethod
+    def _call(source, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) paced by the rate limiter of the server source,
+        failing at once with a CircuitOpenError while that server is failing
+        """
+        return get_circuit_breaker(source).call(get_rate_limiter(source).call, func, *args, **kwargs)
+
+    def download_to_file(self, url, localfn, proxy_url=None, proxy_key=None, revalidate=False, timeout=None,
+                         on_response=None, cancel=None):
+        """
+        Download url (through the proxy if proxy_url and proxy_key are
+        set) to localfn without holding the whole file in memory.
+
+        The body is written to localfn + '.part', which is only renamed to
+        localfn once complete. If the transfer breaks part way through,
+        the partial file is kept and the download resumes from its size
+        with an HTTP Range request (now, up to download_retries times, or on
+        a later call). The ETag (or Last-Modified) of the response the
+        partial file started with is kept in localfn + '.part.validator'
+        and sent as If-Range, so a file changed in between is fetched whole
+        instead of being resumed from the old version.
+
+        If revalidate is True and localfn is already cached, a conditional
+        request is sent using the validators stored in the cache index,
+        and nothing is downloaded unless the remote file changed.
+        Returns True if the file was downloaded, False if it was not modified.
+        timeout overrides the transport's timeout for each request.
+
+        on_response is called (without arguments) when the first response
+        arrives. If the threading.Event cancel is set, the download stops
+        at the next chunk, removes its partial file and raises
+        DownloadCancelledError.
+        """
+        fn = os.path.basename(localfn)
+        partfn = localfn + '.part'
+        validatorfn = partfn + '.validator'
+        for attempt in range(download_retries + 1):
+            offset = os.path.getsize(partfn) if os.path.exists(partfn) else 0
+            headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else dict()
+            if offset > 0 and os.path.exists(validatorfn):
+                with open(validatorfn) as f:
+                    headers['If-Range'] = f.read()
+            if revalidate and offset == 0:
+                headers.update(self._conditional_headers(fn, localfn))
+            try:
+                response = self.get_response(url, proxy_url, proxy_key, stream=True, headers=headers, timeout=timeout)
+            except requests.exceptions.RequestException as ex:
+                log.warning(f"{url} download attempt {attempt + 1} failed: {str(ex)}")
+                continue
+            if on_response is not None:
+                on_response()
+                on_response = None
+            try:
+                if response.status_code == 304:
+                    log.debug(f"{url} not modified")
+                    return False
+                if response.status_code == 416:
+                    # The partial file does not match the remote file any more
+                    os.remove(partfn)
+                    continue
+                if response.status_code == 404:
+                    raise FileNotFoundError(f"{url} not found")
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{url} Ошибка запроса - ответ пришел с кодом {response.status_code}")
+                content_range = response.headers.get('Content-Range', '')
+                if response.status_code == 206 and content_range.startswith('bytes %d-' % offset):
+                    mode = 'ab'
+                else:
+                    # The server sent the whole file (Range not supported, or it changed)
+                    mode = 'wb'
+                    self._keep_validator(validatorfn, response)
+                with open(partfn, mode) as f:
+                    for chunk in response.iter_content(chunk_size=download_chunk_size):
+                        if cancel is not None and cancel.is_set():
+                            break
+                        f.write(chunk)
+                if cancel is not None and cancel.is_set():
+                    os.remove(partfn)
+                    self._keep_validator(validatorfn, None)
+                    raise DownloadCancelledError(f"{url} download cancelled")
+            except requests.exceptions.RequestException as ex:
+                log.warning(f"{url} download attempt {attempt + 1} failed after "
+                            f"{os.path.getsize(partfn) if os.path.exists(partfn) else 0} bytes: {str(ex)}")
+                continue
+            finally:
+                response.close()
+            os.replace(partfn, localfn)
+            self._keep_validator(validatorfn, None)
+            self.cache_index.put(fn,
+                                 etag=response.headers.get('ETag'),
+                                 last_modified=response.headers.get('Last-Modified'),
+                                 size=os.path.getsize(localfn))
+            return True
+        raise RuntimeError(f"{url} download failed after {download_retries + 1} attempts, "
+                           f"partial file kept at {partfn}")
+
+    @staticmethod
+    def _keep_validator(validatorfn, response):
+        """
+        Store the ETag (or else Last-Modified) of response in validatorfn
+        for resuming its partial file, removing validatorfn if there is none
+        """
+        validator = None
+        if response is not None:
+            validator = response.headers.get('ETag', response.headers.get('Last-Modified'))
+        if validator is None:
+            if os.path.exists(validatorfn):
+                os.remove(validatorfn)
+            return
+        with open(validatorfn, 'w') as f:
+            f.write(validator)
+
+    def _conditional_headers(self, fn, localfn):
+        """
+        Headers making a request conditional on the remote file having
+        changed since the cached copy of fn was downloaded
+        """
+        validators = self.cache_index.get(fn)
+        if not os.path.exists(localfn) or validators is None:
+            return dict()
+        if validators['size'] is not None and validators['size'] != os.path.getsize(localfn):
+            # The cached copy is damaged, download it again
+            return dict()
+        headers = dict()
+        if validators['etag'] is not None:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified'] is not None:
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def available_range(self, cadence, proxy_url=None, proxy_key=None):
+        """
+        First and last dates available on the NASA server for cadence,
+        from the directory listing (cached for listing_cache_ttl seconds)
+        """
         remotefn = self.ftpdir + '/' + self.cadence_subdir[cadence] + '/'
+        key = omni_listing_cache.key('nasa', self.cdf_or_txt, remotefn, cadence)
+        cached = self.listing_cache.get(key)
+        if cached is not None:
+            return cached
         url = 'https://' + self.ftpserv + remotefn
-        response = self.get_response(url, proxy_url, proxy_key)
+        response = self._call(self._http_source(proxy_url, proxy_key), self.get_response, url, proxy_url, proxy_key)
         tmp = set(re.findall(self.filepatterns[cadence], response.text))
         tmp2 = [datetime.datetime.strptime(d, self.fileformats[cadence]) for d in tmp]
 
@@ -294,21 +580,21 @@ class omni_downloader(object):
         max_date = max(tmp2)
 
         max_date += datetime.timedelta(days=calendar.monthrange(max_date.year, max_date.month)[1])
+        self.listing_cache.put(key, min_date, max_date)
+        return min_date, max_date
 
-        if start_dt < min_date:
-            delta = min_date - start_dt
-            return (start_dt + delta, end_dt + delta)
-        elif end_dt > max_date:
-            delta = end_dt - max_date + datetime.timedelta(days=1)
-            return (start_dt - delta, end_dt - delta)
-        else:
-            return start_dt, end_dt
-
-    def fix_interval_yadisk(self, start_dt, end_dt, cadence, **kwargs):
-        y = yadisk.YaDisk(token=self.yd_token)
-        yadisk_base_dir = self.yd_dir
-        files = [file_inf for file_inf in y.listdir(yadisk_base_dir, fields=['name'])]
-        file_names = [file_inf.name for file_inf in files]
+    def available_range_yadisk(self, cadence):
+        """
+        First and last dates available on Yandex Disk for cadence,
+        from the folder listing (cached for listing_cache_ttl seconds)
+        """
+        key = omni_listing_cache.key('yadisk', self.cdf_or_txt, self.yd_dir, cadence)
+        cached = self.listing_cache.get(key)
+        if cached is not None:
+            return cached
+        self._require_online(f"list {self.yd_dir} on Yandex Disk")
+        backend = omni_yadisk_backend(self.yd_token, self.yd_dir, pool=self.yadisk_pool)
+        file_names = backend.call(backend.list)
         filtered_files = [file for file in file_names if re.match(self.filepatterns_yd[cadence], file)]
         dates = [datetime.datetime.strptime(d, self.fileformats_yd[cadence]) for d in filtered_files]
 
@@ -316,7 +602,25 @@ class omni_downloader(object):
         max_date = max(dates)
 
         max_date += datetime.timedelta(days=calendar.monthrange(max_date.year, max_date.month)[1])
+        self.listing_cache.put(key, min_date, max_date)
+        return min_date, max_date
 
+    def available_range_local(self, cadence):
+        """
+        First and last dates covered by the files of cadence in localdir
+        (in this downloader's format), from the cache index
+        """
+        cached = {fn: entry for fn, entry in self.cache_index.cached(cadence).items()
+                  if re.fullmatch(self.filepatterns_yd[cadence], fn)}
+        if not cached:
+            raise OfflineCacheMissError(f"No {cadence} {self.cdf_or_txt} files in {self.localdir}")
+        min_date = min(datetime.datetime.fromisoformat(entry['startdt']) for entry in cached.values())
+        max_date = max(datetime.datetime.fromisoformat(entry['enddt']) for entry in cached.values())
+        return min_date, max_date
+
+    @staticmethod
+    def _shift_interval(start_dt, end_dt, min_date, max_date):
+        """Move start_dt to end_dt (keeping its length) inside min_date to max_date"""
         if start_dt < min_date:
             delta = min_date - start_dt
             return (start_dt + delta, end_dt + delta)
@@ -326,64 +630,530 @@ class omni_downloader(object):
         else:
             return start_dt, end_dt
 
+    def fix_interval(self, start_dt, end_dt, cadence, proxy_url=None, proxy_key=None):
+        min_date, max_date = self.available_range(cadence, proxy_url=proxy_url, proxy_key=proxy_key)
+        return self._shift_interval(start_dt, end_dt, min_date, max_date)
+
+    def fix_interval_yadisk(self, start_dt, end_dt, cadence, **kwargs):
+        if self.offline:
+            min_date, max_date = self.available_range_local(cadence)
+        else:
+            try:
+                min_date, max_date = self.available_range_yadisk(cadence)
+            except (OSError, RuntimeError) as ex:
+                min_date, max_date = self._range_without_yadisk(cadence, ex, **kwargs)
+        return self._shift_interval(start_dt, end_dt, min_date, max_date)
+
+    def _range_without_yadisk(self, cadence, ex, **kwargs):
+        """
+        First and last dates for cadence when Yandex Disk could not be
+        listed (ex): its last listing, however old, else the NASA listing
+        for text files, else the range of the cached files. The NASA
+        listing of CDFs only has years, it would move intervals to the
+        wrong dates. Raises RuntimeError if none is known.
+        """
+        stale = self.listing_cache.get(omni_listing_cache.key('yadisk', self.cdf_or_txt, self.yd_dir, cadence),
+                                       stale=True)
+        if stale is not None:
+            log.warning(f"Could not list {self.yd_dir} on Yandex Disk ({str(ex)}), using its last listing")
+            return stale
+        if self.cdf_or_txt == 'txt':
+            log.warning(f"Could not list {self.yd_dir} on Yandex Disk ({str(ex)}), "
+                        f"using the range on the NASA server")
+            return self.available_range(cadence, **kwargs)
+        try:
+            min_date, max_date = self.available_range_local(cadence)
+        except OfflineCacheMissError:
+            raise RuntimeError(f"Could not list {self.yd_dir} on Yandex Disk ({str(ex)}) "
+                               f"and no {cadence} files are cached")
+        log.warning(f"Could not list {self.yd_dir} on Yandex Disk ({str(ex)}), using the range of the cached files")
+        return min_date, max_date
+
     def get_cdf(self, dt, cadence, proxy_url=None, proxy_key=None):
         # print(f"{cadence=}, {dt=}")
         remotefn = self.ftpdir + '/' + self.cadence_subdir[cadence] + '/' + self.filename_gen[cadence](dt)
         remote_path, fn = '/'.join(remotefn.split('/')[:-1]), remotefn.split('/')[-1]
         localfn = os.path.join(self.localdir, fn)
         # log.debug(f"omnireader.py:292, localfn={localfn}, remote={remote_path}")
-        if not os.path.exists(localfn) or self.force_download:
+        requested_at = time.time()
+        if not self.is_cached(fn) or self.force_download or self.revalidate:
+            self._require_online(f"download {fn}, it is not in {self.localdir}")
             url = 'https://' + self.ftpserv + remotefn
             # log.debug(url)
-            response = self.get_response(url, proxy_url, proxy_key)
-
-            with open(localfn, 'wb') as f:
-                f.write(response.content)
+            source = self._http_source(proxy_url, proxy_key)
+            f = self._planned_file(dt, cadence, cached=())
+            if self.negative_cache.is_missing(source, f):
+                raise FileNotFoundError(f"{url} was not found when last asked")
+            # One download of a file at a time, the others use its result
+            with omni_file_lock(localfn):
+                try:
+                    if not self._fetched_since(fn, requested_at) and self._download_verified(
+                            url, f, source, proxy_url, proxy_key,
+                            revalidate=self.revalidate and not self.force_download):
+                        self.local_cache.evict()
+                except FileNotFoundError:
+                    self.negative_cache.add(source, f)
+                    raise
+        self.local_cache.touch(fn)
 
         if self.cdf_or_txt == 'txt':
             return omni_txt_cdf_mimic(localfn, cadence)
         elif self.cdf_or_txt == 'cdf':
             return pycdf.CDF(localfn)
 
-    def get_cdf_from_ya_disk(self, dt, cadence, **kwargs):
-        y = yadisk.YaDisk(token=self.yd_token)
-        yadisk_base_dir = self.yd_dir
-        fn = self.filename_gen_yd[cadence](dt)
-        remotefn = yadisk_base_dir + '/' + fn
-        localfn = os.path.join(self.localdir, fn)
-        # log.debug(f"omnireader.py:292, localfn={localfn}, remote={remote_path}")
-        if not os.path.exists(localfn) or self.force_download:
-            y.download(remotefn, localfn)
+    def file_span(self, dt, cadence):
+        """
+        Start (inclusive) and end (exclusive) of the span of time
+        covered by the file holding dt
+        """
+        months = self.file_months[cadence]
+        startdt = datetime.datetime(dt.year, (dt.month - 1) // months * months + 1, 1)
+        month = startdt.month - 1 + months
+        return startdt, datetime.datetime(startdt.year + month // 12, month % 12 + 1, 1)
+
+    def plan_files(self, startdt, enddt, cadence):
+        """
+        Work out the ordered list of files (omni_planned_file) needed
+        to cover startdt to enddt, using only the dates and the cache
+        index. Nothing is downloaded or opened, so the plan can be used
+        for prefetching, cache checks and cost estimates.
+        """
+        cached = self.cache_index.cached(cadence)
+        dt, next_dt = self.file_span(startdt, cadence)
+        files = []
+        while True:
+            files.append(self._planned_file(dt, cadence, cached))
+            # The file covering enddt is the last one needed
+            if next_dt >= enddt:
+                break
+            dt, next_dt = self.file_span(next_dt, cadence)
+        return files
+
+    def _planned_file(self, dt, cadence, cached):
+        """The omni_planned_file for the file holding dt, cached is from cache_index.cached"""
+        startdt, enddt = self.file_span(dt, cadence)
+        fn = self.filename_gen_yd[cadence](startdt)
+        remotefn = self.ftpdir + '/' + self.cadence_subdir[cadence] + '/' + self.filename_gen[cadence](startdt)
+        return omni_planned_file(startdt, enddt, cadence, fn, remotefn, os.path.join(self.localdir, fn),
+                                 fn in cached)
+
+    def is_cached(self, fn):
+        """Whether the file fn is in localdir, according to the cache index"""
+        entry = self.cache_index.get(fn)
+        if entry is None or entry['fetched_at'] is None:
+            return False
+        if not os.path.exists(os.path.join(self.localdir, fn)):
+            # Removed from outside this package
+            self.cache_index.remove(fn)
+            return False
+        return True
+
+    def _record_fetch(self, dt, cadence, localfn, source, fetched_at=None):
+        """Add a file just put in localdir to the cache index"""
+        startdt, enddt = self.file_span(dt, cadence)
+        self.cache_index.put(os.path.basename(localfn),
+                             cadence=cadence,
+                             startdt=startdt.isoformat(),
+                             enddt=enddt.isoformat(),
+                             size=os.path.getsize(localfn),
+                             checksum=file_md5(localfn),
+                             source=source,
+                             fetched_at=time.time() if fetched_at is None else fetched_at)
+
+    def _index_untracked_files(self):
+        """Add the files cached before the cache index existed to it"""
+        indexed = self.cache_index.cached()
+        for fn in os.listdir(self.localdir):
+            if fn in indexed:
+                continue
+            for cadence in self.filepatterns_yd:
+                if re.fullmatch(self.filepatterns_yd[cadence], fn):
+                    localfn = os.path.join(self.localdir, fn)
+                    dt = datetime.datetime.strptime(fn, self.fileformats_yd[cadence])
+                    self._record_fetch(dt, cadence, localfn, None, fetched_at=os.path.getmtime(localfn))
+                    break
+
+    def fetch_file(self, dt, cadence, fetched_since=None):
+        """
+        Path in localdir of the file holding dt. If it is not cached (or
+        force_download is set, or revalidate is set and it changed) it is
+        fetched from the first of the tiers which has it. A copy fetched
+        (or revalidated) at or after the time fetched_since is used as it
+        is (e.g. by an interval which prefetched its files).
+        """
+        f = self._planned_file(dt, cadence, cached=())
+        self.local_cache.touch(f.filename)
+        requested_at = time.time()
+        if fetched_since is not None and self._fetched_since(f.filename, fetched_since) and self._verified(f):
+            return f.localfn
+        if self.is_cached(f.filename) and not self.force_download and self._verified(f):
+            if not self.revalidate:
+                return f.localfn
+            if not self._changed_on_tiers(f):
+                self.cache_index.put(f.filename, revalidated_at=time.time())
+                return f.localfn
+        self._require_online(f"fetch {f.filename}, it is not in {self.localdir}")
+        if all(self.negative_cache.is_missing(tier.name, f) for tier in self.tiers):
+            raise FileNotFoundError(f"{f.filename} was not on any tier when last asked")
+        # One fetch of a file at a time (across threads and processes), the others use its result
+        with omni_file_lock(f.localfn):
+            if self._fetched_since(f.filename, requested_at):
+                return f.localfn
+            errors = []
+            missing = True
+            for tier in self.tiers:
+                if self.negative_cache.is_missing(tier.name, f):
+                    continue
+                if tier.breaker.is_open():
+                    # Fail over to the next tier at once
+                    log.debug(f"Not asking {tier.name} for {f.filename}, it is failing")
+                    errors.append(f"{tier.name}: failing, not asked")
+                    missing = False
+                    continue
+                try:
+                    self._fetch_verified(tier, f)
+                except FileNotFoundError as ex:
+                    log.debug(f"{f.filename} is not on {tier.name}")
+                    self.negative_cache.add(tier.name, f)
+                    errors.append(f"{tier.name}: {str(ex)}")
+                    continue
+                except (OSError, RuntimeError) as ex:
+                    log.warning(f"Could not fetch {f.filename} from {tier.name}: {str(ex)}")
+                    errors.append(f"{tier.name}: {str(ex)}")
+                    missing = False
+                    continue
+                self.local_cache.evict()
+                return f.localfn
+        if missing:
+            raise FileNotFoundError(f"{f.filename} is not on any tier. {'; '.join(errors)}")
+        raise RuntimeError(f"Could not fetch {f.filename} from any tier. {'; '.join(errors)}")
+
+    def _fetch_verified(self, tier, f):
+        """
+        Fetch f from tier into localdir and add it to the cache index,
+        fetching it again (up to corrupt_retries times) while it arrives
+        corrupt. Raises CorruptFileError if it never arrived whole.
+        """
+        for attempt in range(corrupt_retries + 1):
+            tier.call(tier.fetch, f, f.localfn)
+            compress_file(f.localfn, self.compression)
+            self._record_fetch(f.startdt, f.cadence, f.localfn, tier.name)
+            if self._verify(f):
+                return
+        raise CorruptFileError(f"{f.filename} from {tier.name} was corrupt {corrupt_retries + 1} times")
+
+    def _download_verified(self, url, f, source, proxy_url=None, proxy_key=None, revalidate=False):
+        """
+        download_to_file for the planned file f, adding it to the cache
+        index and downloading it again while it arrives corrupt, as
+        _fetch_verified does. Returns False if it had not changed.
+        """
+        for attempt in range(corrupt_retries + 1):
+            if not self._call(source, self.download_to_file, url, f.localfn, proxy_url, proxy_key,
+                              revalidate=revalidate):
+                return False
+            compress_file(f.localfn, self.compression)
+            self._record_fetch(f.startdt, f.cadence, f.localfn, source)
+            if self._verify(f):
+                return True
+            revalidate = False
+        raise CorruptFileError(f"{url} was corrupt {corrupt_retries + 1} times")
+
+    def _verify(self, f):
+        """
+        Check that the cached copy of f is whole and well formed, recording
+        when in the cache index (unless it could only be checked in part,
+        see verify_file). A corrupt file is quarantined. Returns whether
+        it was good.
+        """
+        try:
+            complete = verify_file(f.localfn, self.cdf_or_txt, f.cadence, f.startdt, f.enddt)
+        except CorruptFileError as ex:
+            self._quarantine(f, str(ex))
+            return False
+        if complete:
+            self.cache_index.put(f.filename, verified_at=time.time())
+        return True
+
+    def _verified(self, f):
+        """
+        Whether the cached copy of f is good: checked now if it was not
+        since it was fetched (e.g. cached by an older version)
+        """
+        entry = self.cache_index.get(f.filename)
+        if entry is not None and entry['verified_at'] is not None:
+            return True
+        return self._verify(f)
 
+    def _quarantine(self, f, reason):
+        """
+        Move the corrupt cached copy of f out of localdir (so it is never
+        read, and can be looked at later) and drop it from the cache index.
+        If it can not be moved it is removed.
+        """
+        directory = quarantine_dir if quarantine_dir is not None else os.path.join(self.localdir, 'quarantine')
+        quarantinefn = os.path.join(directory, f"{f.filename}.{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}")
+        log.warning(f"Quarantining {f.filename} to {quarantinefn}: {reason}")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # quarantine_dir may be on another filesystem
+            shutil.move(f.localfn, quarantinefn)
+        except OSError as ex:
+            log.error(f"Could not quarantine {f.filename} ({str(ex)}), removing it")
+            if os.path.exists(f.localfn):
+                os.remove(f.localfn)
+        finally:
+            self.cache_index.remove(f.filename)
+
+    def _fetched_since(self, fn, requested_at):
+        """Whether fn was fetched, or found unchanged (by another thread or process) after requested_at"""
+        entry = self.cache_index.get(fn)
+        return (entry is not None and entry['fetched_at'] is not None
+                and max(entry['fetched_at'], entry['revalidated_at'] or 0.) >= requested_at
+                and os.path.exists(os.path.join(self.localdir, fn)))
+
+    def _changed_on_tiers(self, f):
+        """
+        Ask the first tier which has f whether it changed since the cached
+        copy was fetched: with a conditional request (the stored ETag and
+        Last-Modified) if the tier supports them, else by comparing the size
+        and (if known) checksum of the copies. A compressed copy matches a
+        tier's copy if either it or its content does.
+        """
+        for tier in self.tiers:
+            try:
+                modified = tier.call(tier.modified, f, self._conditional_headers(f.filename, f.localfn))
+                if modified is not None:
+                    return modified
+                stat = tier.call(tier.stat, f)
+            except (OSError, RuntimeError) as ex:
+                log.debug(f"Could not check {f.filename} on {tier.name}: {str(ex)}")
+                continue
+            sizes, checksums = [os.path.getsize(f.localfn)], []
+            if is_compressed(f.localfn):
+                content_size, content_md5 = content_stat(f.localfn)
+                sizes.append(content_size)
+                checksums.append(content_md5)
+            if stat.size is not None and stat.size not in sizes:
+                return True
+            if stat.md5 is None:
+                return False
+            entry = self.cache_index.get(f.filename)
+            if entry is not None and entry['checksum'] is not None:
+                checksums.append(entry['checksum'])
+            else:
+                checksums.append(file_md5(f.localfn))
+            return stat.md5 not in checksums
+        log.warning(f"Could not revalidate {f.filename} on any tier, using the cached copy")
+        return False
+
+    def prefetch_from_ya_disk(self, startdt, enddt, cadence, max_workers=None, **kwargs):
+        """
+        Fetch all the files needed for startdt to enddt from the tiers at
+        the same time on a bounded thread pool, so that a multi-file interval
+        costs about one round trip instead of one per file
+        """
+        files = self.plan_files(startdt, enddt, cadence)
+        if not self.force_download and not self.revalidate:
+            files = [f for f in files if not f.cached]
+        if not files:
+            return
+        if self.offline:
+            # Fail before opening anything
+            raise OfflineCacheMissError(f"Working offline and {[f.filename for f in files]} "
+                                        f"are not in {self.localdir}")
+        max_workers = prefetch_workers if max_workers is None else max_workers
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+            # list() so that exceptions from the workers are raised here
+            list(executor.map(lambda f: self.fetch_file(f.startdt, cadence), files))
+
+    def get_cdf_from_ya_disk(self, dt, cadence, fetched_since=None, **kwargs):
+        localfn = self.fetch_file(dt, cadence, fetched_since=fetched_since)
+        self.readahead_threads.used(localfn)
+        self.read_ahead(dt, cadence)
+        return self.open_file(localfn, cadence)
+
+    def read_ahead(self, dt, cadence):
+        """
+        Fetch the readahead files after the (cached) one holding dt in
+        the background, as far as the read-ahead byte budget allows,
+        taking each to be about the size of this one
+        """
+        if self.readahead <= 0 or self.offline or self.force_download:
+            return
+        f = self._planned_file(dt, cadence, cached=())
+        estimate = os.path.getsize(f.localfn)
+        now = datetime.datetime.now()
+        for i in range(self.readahead):
+            f = self._planned_file(f.enddt, cadence, cached=())
+            if f.startdt > now:
+                # Not published yet
+                break
+            if self.is_cached(f.filename) or all(self.negative_cache.is_missing(tier.name, f) for tier in self.tiers):
+                continue
+            if not self.readahead_threads.schedule(self, f, estimate):
+                break
+
+    def open_file(self, localfn, cadence):
+        """Open a file in localdir as a pycdf.CDF (or omni_txt_cdf_mimic for text files)"""
         if self.cdf_or_txt == 'txt':
             return omni_txt_cdf_mimic(localfn, cadence)
         elif self.cdf_or_txt == 'cdf':
             return pycdf.CDF(localfn)
 
+    def refresh_tail(self, dt, cadence, proxy_url=None, proxy_key=None):
+        """
+        Bring the cached file holding dt up to date with the NASA server
+        (through the proxy if proxy_url and proxy_key are set), for files
+        which NASA is still adding to. A text file only grows, so only its
+        new bytes are fetched, with a Range request from the start of the
+        cached last line (if that line changed, the file was rewritten
+        since and is fetched whole). CDFs
+        can not be extended by bytes; they are revalidated with a
+        conditional request and fetched whole if they changed.
+
+        Returns the byte offset the new data starts at in the cached file:
+        its old size if it was extended, 0 if it was fetched whole, or
+        None if it had not changed.
+        """
+        f = self._planned_file(dt, cadence, cached=())
+        url = 'https://' + self.ftpserv + f.remotefn
+        source = self._http_source(proxy_url, proxy_key)
+        self._require_online(f"refresh {f.filename}")
+        with omni_file_lock(f.localfn):
+            cached = self.is_cached(f.filename)
+            if cached and self.cdf_or_txt == 'txt':
+                appended_from = self._call(source, self._append_tail, url, f.localfn, proxy_url, proxy_key)
+                if appended_from is not None:
+                    self._record_fetch(dt, cadence, f.localfn, source)
+                    if not self._verify(f):
+                        # The tail did not fit on the cached file, start again from a whole one
+                        self._download_verified(url, f, source, proxy_url, proxy_key)
+                        appended_from = 0
+            elif self._download_verified(url, f, source, proxy_url, proxy_key, revalidate=cached):
+                appended_from = 0
+            else:
+                appended_from = None
+            if appended_from is not None:
+                self.local_cache.evict()
+        self.local_cache.touch(f.filename)
+        return appended_from
+
+    def _append_tail(self, url, localfn, proxy_url=None, proxy_key=None):
+        """
+        Append the bytes of url past the size of localfn to it, see
+        refresh_tail for the return value
+        """
+        fn = os.path.basename(localfn)
+        # The new bytes start after the content of the file, they are added at the end of the file as stored
+        offset = content_stat(localfn)[0] if is_compressed(localfn) else os.path.getsize(localfn)
+        stored_size = os.path.getsize(localfn)
+        # The request starts at the cached last line, which must come back unchanged. If-Range can not
+        # tell, the ETag and Last-Modified of a file change as it grows (and files from Yandex Disk have none).
+        tail = content_tail(localfn, 1024)
+        overlap = tail[tail.rfind(b'\n', 0, len(tail) - 1) + 1:]
+        headers = {'Range': 'bytes=%d-' % (offset - len(overlap))}
+        # The new bytes are written in full before the cached file is touched
+        partfn = localfn + '.tail'
+        while True:
+            response = self.get_response(url, proxy_url, proxy_key, stream=True, headers=headers)
+            try:
+                if response.status_code == 404:
+                    raise FileNotFoundError(f"{url} not found")
+                if response.status_code == 416 and overlap:
+                    # Shorter than the cached copy
+                    head = None
+                else:
+                    if response.status_code >= 400:
+                        raise RuntimeError(f"{url} Ошибка запроса - ответ пришел с кодом {response.status_code}")
+                    content_range = response.headers.get('Content-Range', '')
+                    appended_from = stored_size if response.status_code == 206 and content_range.startswith(
+                        'bytes %d-' % (offset - len(overlap))) else 0
+                    if appended_from == 0:
+                        overlap = b''
+                    head = b''
+                    with open(partfn, 'wb') as part:
+                        for chunk in response.iter_content(chunk_size=download_chunk_size):
+                            if len(head) < len(overlap):
+                                n = len(overlap) - len(head)
+                                head, chunk = head + chunk[:n], chunk[n:]
+                            part.write(chunk)
+            finally:
+                response.close()
+            if head == overlap:
+                break
+            log.info(f"{url} is not the cached {fn} with lines added, fetching it whole")
+            overlap = b''
+            headers = dict()
+        if appended_from != 0 and os.path.getsize(partfn) == 0:
+            log.debug(f"{url} has not grown past {offset} bytes")
+            os.remove(partfn)
+            return None
+        if appended_from == 0:
+            os.replace(partfn, localfn)
+            compress_file(localfn, self.compression)
+        else:
+            append_file(localfn, partfn)
+            os.remove(partfn)
+        self.cache_index.put(fn,
+                             etag=response.headers.get('ETag'),
+                             last_modified=response.headers.get('Last-Modified'),
+                             size=os.path.getsize(localfn))
+        return appended_from
+
     def load_from_nasa_to_yadisk(self, dt, cadence, proxy_url, proxy_key):
-        y = yadisk.YaDisk(token=self.yd_token)
+        """
+        Copy the file for dt from the NASA server to Yandex Disk, if it
+        arrives whole (see verify_file). Each call downloads to its own
+        temporary file, so any number of copies can run at the same time
+        in threads or processes. Returns True if the file was uploaded,
+        False if it was skipped (NASA does not have it, or it could not
+        be downloaded or uploaded).
+        """
         fn = self.filename_gen[cadence](dt)
         fn_yd = self.filename_gen_yd[cadence](dt)
         log.debug(fn)
         remotefn = self.ftpdir + '/' + self.cadence_subdir[cadence] + '/' + fn
-        yd_remotefn = self.yd_dir + '/' + fn_yd
         url = 'https://' + self.ftpserv + remotefn
         # log.debug(url)
+        self._require_online(f"copy {fn} to Yandex Disk")
+        source = self._http_source(proxy_url, proxy_key)
+        f = self._planned_file(dt, cadence, cached=())
+        if self.negative_cache.is_missing(source, f):
+            log.debug(f'skip {url}, not found when last asked')
+            return False
+        fd, localfn = tempfile.mkstemp(prefix='.' + fn_yd + '.', suffix='.upload', dir=self.localdir)
+        os.close(fd)
         try:
-            response = self.get_response(url, proxy_url, proxy_key)
-        except RuntimeError as ex:
-            log.error(f'skip {str(ex)}')
-            return
-        log.debug(response.status_code)
-        if response.status_code >= 400:
-            log.error(f'skip {response.status_code}')
-            return
-
-        localfn = 'ya_disk_download_tmp'
+            try:
+                self._call(source, self.download_to_file, url, localfn, proxy_url, proxy_key)
+            except FileNotFoundError as ex:
+                self.negative_cache.add(source, f)
+                log.error(f'skip {str(ex)}')
+                return False
+            except (OSError, RuntimeError) as ex:
+                log.error(f'skip {str(ex)}')
+                return False
+            try:
+                # An error page or a cut short body must not end up on Yandex Disk
+                verify_file(localfn, self.cdf_or_txt, cadence, f.startdt, f.enddt)
+            except CorruptFileError as ex:
+                log.error(f'skip {str(ex)}')
+                return False
 
-        with open(localfn, 'wb') as f:
-            f.write(response.content)
-        y.upload(localfn, yd_remotefn, overwrite=True, timeout=60.0)
+            compress_file(localfn, self.compression)
+            backend = omni_yadisk_backend(self.yd_token, self.yd_dir, pool=self.yadisk_pool)
+            try:
+                backend.call(backend.upload, localfn, f)
+            except (OSError, RuntimeError) as ex:
+                log.error(f'skip {fn_yd}, could not upload it: {str(ex)}')
+                return False
+        finally:
+            for tmpfn in [localfn, localfn + '.part', localfn + '.part.validator', localfn + '.compressing']:
+                if os.path.exists(tmpfn):
+                    os.remove(tmpfn)
+            self.cache_index.remove(os.path.basename(localfn))
+        return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+import datetime
+import hashlib
+import os
+import pytest
+import shutil
+import threading
+import yadisk
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class omni_test_handler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the NASA server (and the proxy), serving the
+    bytes in server.files by path
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.client_ports.add(self.client_address[1])
+        server.requests.append((self.path, dict(self.headers)))
+        if server.status_codes:
+            # Answer with the next queued error instead of the file
+            status, retry_after = server.status_codes.pop(0)
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header('Retry-After', retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = self.path.split('?')[0]
+        if path == '/proxy':
+            # Proxied requests are for the path of the url parameter
+            path = urlparse(parse_qs(urlparse(self.path).query)['url'][0]).path
+        if path not in server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = server.files[path]
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        offset = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header is not None and server.supports_range and if_range in (None, etag):
+            offset = int(range_header.split('=')[1].split('-')[0])
+            if offset >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        body = body[offset:]
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # Drop the connection part way through the body
+        if path in server.truncate_after:
+            self.wfile.write(body[:server.truncate_after.pop(path)])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_minute_lines(startdt, n):
+    """Fixed width lines of a 1 minute OMNI text file, starting at startdt"""
+    lines = []
+    for i in range(n):
+        dt = startdt + datetime.timedelta(minutes=i)
+        lines.append('%4d %3d %2d %2d' % (dt.year, dt.timetuple().tm_yday, dt.hour, dt.minute)
+                     + ' %7.2f' * 42 % ((1.5,) * 42) + '\n')
+    return ''.join(lines).encode()
+
+
+@pytest.fixture
+def minute_lines():
+    """make_minute_lines, for tests writing text files"""
+    return make_minute_lines
+
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), omni_test_handler)
+    server.files = dict()
+    server.truncate_after = dict()
+    server.status_codes = []  # (status, Retry-After or None) to answer the next requests with
+    server.supports_range = True
+    server.client_ports = set()
+    server.requests = []
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def local_cdf_dir(tmp_path, monkeypatch):
+    """Keep the files (and cache index) each test writes out of the real local_cdf_dir"""
+    from nasaomnireader import (omnireader, omni_circuit_breaker, omni_latency, omni_listing_cache,
+                                omni_negative_cache, omni_rate_limiter, omni_readahead, omni_yadisk_pool)
+    omni_readahead.get_readahead().clear()
+    cache_dir = tmp_path / 'local_cdf_dir'
+    cache_dir.mkdir()
+    monkeypatch.setattr(omnireader, 'localdir', str(cache_dir))
+    omni_listing_cache.get_listing_cache().clear()
+    omni_yadisk_pool.get_yadisk_pool().close()
+    omni_rate_limiter.clear_rate_limiters()
+    omni_negative_cache.get_negative_cache().clear()
+    omni_latency.clear_latency_trackers()
+    omni_circuit_breaker.clear_circuit_breakers()
+    return cache_dir
+
+
+class fake_yadisk_resource(object):
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.md5 = hashlib.md5(f.read()).hexdigest()
+        self.size = os.path.getsize(path)
+        self.modified = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+class fake_yadisk(object):
+    """Stand-in for yadisk.YaDisk, keeping the folder's files in a local directory"""
+    remote_dir = None
+    downloads = []
+    uploads = []
+    listings = 0
+    instances = 0
+
+    def __init__(self, token=None, **kwargs):
+        self.token = token
+        fake_yadisk.instances += 1
+
+    def close(self):
+        pass
+
+    def _path(self, path):
+        return os.path.join(self.remote_dir, path.split('/')[-1])
+
+    def _existing_path(self, path):
+        if not os.path.exists(self._path(path)):
+            raise yadisk.exceptions.PathNotFoundError(msg=path)
+        return self._path(path)
+
+    def listdir(self, path, **kwargs):
+        fake_yadisk.listings += 1
+        return [fake_yadisk_resource(self._path(name)) for name in sorted(os.listdir(self.remote_dir))]
+
+    def get_meta(self, path, **kwargs):
+        return fake_yadisk_resource(self._existing_path(path))
+
+    def download(self, src_path, dst_path, **kwargs):
+        fake_yadisk.downloads.append(src_path)
+        shutil.copyfile(self._existing_path(src_path), dst_path)
+
+    def upload(self, src_path, dst_path, **kwargs):
+        fake_yadisk.uploads.append(dst_path)
+        shutil.copyfile(src_path, self._path(dst_path))
+
+
+@pytest.fixture
+def fake_ya_disk(tmp_path, monkeypatch):
+    """An empty Yandex Disk folder, which every Yandex Disk client in the process talks to"""
+    from nasaomnireader import omni_yadisk_pool
+    remote_dir = tmp_path / 'ya_disk'
+    remote_dir.mkdir()
+    monkeypatch.setattr(fake_yadisk, 'remote_dir', str(remote_dir))
+    monkeypatch.setattr(fake_yadisk, 'downloads', [])
+    monkeypatch.setattr(fake_yadisk, 'uploads', [])
+    monkeypatch.setattr(fake_yadisk, 'listings', 0)
+    monkeypatch.setattr(fake_yadisk, 'instances', 0)
+    monkeypatch.setattr(omni_yadisk_pool.yadisk, 'YaDisk', fake_yadisk)
+    return fake_yadisk
@@ -0,0 +1,256 @@
+from nasaomnireader import omnireader
+from nasaomnireader.omni_backends import (omni_dir_backend, omni_http_backend, omni_hedged_backend, omni_yadisk_backend,
+                                          build_tiers, DownloadCancelledError)
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import pytest
+import threading
+import time
+
+
+def write_file(directory, filename, body):
+    with open(os.path.join(str(directory), filename), 'wb') as f:
+        f.write(body)
+
+
+@pytest.fixture
+def mirror_dir(tmp_path):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    return mirror
+
+
+def test_dir_backend(mirror_dir, local_cdf_dir, minute_lines):
+    """Test listing, stat, fetch and upload on a directory, and missing files"""
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    jan, feb = od.plan_files(datetime.datetime(2006, 1, 10), datetime.datetime(2006, 2, 10), '1min')
+    write_file(mirror_dir, jan.filename, minute_lines(datetime.datetime(2006, 1, 1), 10))
+    backend = omni_dir_backend(str(mirror_dir))
+    assert backend.list() == ['omni_min200601.asc']
+    assert backend.stat(jan).size == len(minute_lines(datetime.datetime(2006, 1, 1), 10))
+    backend.fetch(jan, jan.localfn)
+    with open(jan.localfn, 'rb') as f:
+        assert f.read() == minute_lines(datetime.datetime(2006, 1, 1), 10)
+    with pytest.raises(FileNotFoundError):
+        backend.fetch(feb, feb.localfn)
+    assert not os.path.exists(feb.localfn)
+    backend.upload(jan.localfn, feb)
+    assert backend.list() == ['omni_min200601.asc', 'omni_min200602.asc']
+
+
+def test_tiers_fall_through(mirror_dir, fake_ya_disk, minute_lines):
+    """
+    Test that a file is fetched from the first tier which has it,
+    and the tier is recorded in the cache index
+    """
+    write_file(mirror_dir, 'omni_min200601.asc', minute_lines(datetime.datetime(2006, 1, 1), 10))
+    write_file(fake_ya_disk.remote_dir, 'omni_min200601.asc', minute_lines(datetime.datetime(2006, 1, 1), 20))
+    write_file(fake_ya_disk.remote_dir, 'omni_min200602.asc', minute_lines(datetime.datetime(2006, 2, 1), 20))
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt',
+                                    tiers=[omni_dir_backend(str(mirror_dir)), omni_yadisk_backend('token', '/omni')])
+    od.prefetch_from_ya_disk(datetime.datetime(2006, 1, 10), datetime.datetime(2006, 2, 10), '1min')
+    assert fake_ya_disk.downloads == ['/omni/omni_min200602.asc']
+    cached = od.cache_index.cached('1min')
+    assert cached['omni_min200601.asc']['source'] == 'mirror'
+    assert cached['omni_min200602.asc']['source'] == 'yadisk'
+    with pytest.raises(FileNotFoundError):
+        od.fetch_file(datetime.datetime(2006, 3, 1), '1min')
+
+
+def test_proxy_tier(local_server, fake_ya_disk, minute_lines):
+    """Test that the proxy tier is used only with proxy credentials, and after Yandex Disk"""
+    local_server.files['/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'] = minute_lines(
+        datetime.datetime(2006, 1, 1), 10)
+    specs = [{'type': 'yadisk'}, {'type': 'proxy', 'timeout': 5.}]
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    assert [tier.name for tier in build_tiers(od, specs)] == ['yadisk']
+    tiers = build_tiers(od, specs, proxy_url=local_server.url + '/proxy', proxy_key='key')
+    assert [tier.name for tier in tiers] == ['yadisk', 'proxy']
+    assert isinstance(tiers[1], omni_http_backend)
+    od.tiers = tiers
+    od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    assert od.cache_index.get('omni_min200601.asc')['source'] == 'proxy'
+    assert local_server.requests[0][1]['apikey'] == 'key'
+
+
+def test_proxy_tier_revalidates_with_validators(local_server, minute_lines):
+    """
+    Test that revalidating through the proxy sends the stored ETag, so a
+    file revised without changing size is fetched again and an unchanged
+    one is not
+    """
+    path = '/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'
+    local_server.files[path] = minute_lines(datetime.datetime(2006, 1, 1), 10)
+    specs = [{'type': 'proxy'}]
+    proxy = dict(proxy_url=local_server.url + '/proxy', proxy_key='key')
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    od.tiers = build_tiers(od, specs, **proxy)
+    localfn = od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[], revalidate=True)
+    od.tiers = build_tiers(od, specs, **proxy)
+    n_requests = len(local_server.requests)
+    od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    assert len(local_server.requests) == n_requests + 1
+    assert 'If-None-Match' in local_server.requests[-1][1]
+
+    local_server.files[path] = local_server.files[path].replace(b'1.50', b'2.50')
+    od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    with open(localfn, 'rb') as f:
+        assert f.read() == local_server.files[path]
+
+
+class blocking_dir_backend(omni_dir_backend):
+    """Holds each fetch until as many as expected run at once (or a timeout), recording the most at once"""
+
+    def __init__(self, root, expected, **kwargs):
+        super(blocking_dir_backend, self).__init__(root, **kwargs)
+        self.expected = expected
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.condition = threading.Condition()
+
+    def fetch(self, f, localfn):
+        with self.condition:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: self.most_in_flight >= self.expected, timeout=5.)
+        try:
+            super(blocking_dir_backend, self).fetch(f, localfn)
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+
+
+def test_prefetch_fetches_at_the_same_time(mirror_dir, minute_lines):
+    """Test that prefetching an interval fetches its files at the same time, prefetch_workers at most"""
+    for month in range(1, 7):
+        write_file(mirror_dir, 'omni_min2006%.2d.asc' % month, minute_lines(datetime.datetime(2006, month, 1), 10))
+    backend = blocking_dir_backend(str(mirror_dir), omnireader.prefetch_workers)
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[backend])
+    od.prefetch_from_ya_disk(datetime.datetime(2006, 1, 10), datetime.datetime(2006, 6, 10), '1min')
+    assert backend.most_in_flight == omnireader.prefetch_workers > 1
+    assert len(od.cache_index.cached('1min')) == 6
+
+
+class slow_dir_backend(omni_dir_backend):
+    fetches = 0
+
+    def fetch(self, f, localfn):
+        slow_dir_backend.fetches += 1
+        time.sleep(.2)
+        super(slow_dir_backend, self).fetch(f, localfn)
+
+
+@pytest.mark.parametrize('force_download', [False, True])
+def test_concurrent_fetches_are_coalesced(mirror_dir, force_download, minute_lines):
+    """Test that threads asking for the same file at once wait for a single transfer"""
+    write_file(mirror_dir, 'omni_min200601.asc', minute_lines(datetime.datetime(2006, 1, 1), 10))
+    slow_dir_backend.fetches = 0
+    downloaders = [omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', force_download=force_download,
+                                              tiers=[slow_dir_backend(str(mirror_dir))]) for i in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        localfns = list(executor.map(lambda od: od.fetch_file(datetime.datetime(2006, 1, 10), '1min'), downloaders))
+    assert slow_dir_backend.fetches == 1
+    assert len(set(localfns)) == 1
+
+
+def test_missing_files_are_remembered(mirror_dir, fake_ya_disk):
+    """
+    Test that a file no tier has is not asked for again until the
+    negative cache entry expires, sooner for recent months
+    """
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt',
+                                    tiers=[omni_dir_backend(str(mirror_dir)), omni_yadisk_backend('token', '/omni')])
+    for i in range(3):
+        with pytest.raises(FileNotFoundError):
+            od.fetch_file(datetime.datetime(2006, 3, 1), '1min')
+    assert fake_ya_disk.downloads == ['/omni/omni_min200603.asc']
+
+    old, recent = od.plan_files(datetime.datetime(2006, 3, 1), datetime.datetime(2006, 3, 2), '1min')[0], \
+        od.plan_files(datetime.datetime.now(), datetime.datetime.now(), '1min')[0]
+    od.negative_cache.recent_ttl = -1
+    od.negative_cache.add('nasa', old)
+    od.negative_cache.add('nasa', recent)
+    assert od.negative_cache.is_missing('nasa', old)
+    assert not od.negative_cache.is_missing('nasa', recent)
+
+
+class paced_dir_backend(omni_dir_backend):
+    """A directory which takes first_byte_delay seconds to start answering, like a slow server"""
+    asked = []
+
+    def __init__(self, root, name, first_byte_delay):
+        super(paced_dir_backend, self).__init__(root, name=name)
+        self.first_byte_delay = first_byte_delay
+
+    def fetch(self, f, localfn, started=None, cancel=None):
+        paced_dir_backend.asked.append(self.name)
+        if cancel.wait(self.first_byte_delay):
+            raise DownloadCancelledError(f"{f.filename} from {self.name} cancelled")
+        started.set()
+        super(paced_dir_backend, self).fetch(f, localfn)
+
+
+@pytest.mark.parametrize('proxy_delay, winner', [(.01, 'proxy'), (1., 'nasa')])
+def test_hedged_fetch(mirror_dir, minute_lines, proxy_delay, winner):
+    """
+    Test that a hedged tier asks the second source only when the first
+    is slower to answer than the hedge delay, and keeps the first copy
+    """
+    write_file(mirror_dir, 'omni_min200601.asc', minute_lines(datetime.datetime(2006, 1, 1), 10))
+    paced_dir_backend.asked = []
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    hedged = omni_hedged_backend(od, [paced_dir_backend(str(mirror_dir), 'proxy', proxy_delay),
+                                      paced_dir_backend(str(mirror_dir), 'nasa', .01)], delay=.2)
+    assert hedged.name == 'proxy+nasa'
+    od.tiers = [hedged]
+    start = time.monotonic()
+    localfn = od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    assert time.monotonic() - start < .8
+    assert paced_dir_backend.asked == ['proxy', 'nasa'] if winner == 'nasa' else ['proxy']
+    assert os.path.exists(localfn)
+    assert od.cache_index.get('omni_min200601.asc')['source'] == 'proxy+nasa'
+
+
+def test_hedge_delay_follows_latency():
+    """Test that the hedge delay is the default until enough times to first byte were recorded"""
+    from nasaomnireader.omni_latency import get_latency_tracker
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    hedged = omni_hedged_backend(od, [omni_http_backend(od, 'http://proxy', 'key'), omni_http_backend(od)],
+                                 percentile=90, delay=2.)
+    assert hedged.hedge_delay() == 2.
+    for i in range(100):
+        get_latency_tracker('proxy').record(i / 100.)
+    assert hedged.hedge_delay() == pytest.approx(.891)
+
+
+def test_download_can_be_cancelled(local_server, local_cdf_dir):
+    """Test that a cancelled download raises DownloadCancelledError and leaves no partial file"""
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 0' * 100000
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    localfn = os.path.join(str(local_cdf_dir), 'omni_min200601.asc')
+    cancel = threading.Event()
+    responses = []
+
+    def on_response():
+        responses.append(True)
+        cancel.set()
+    with pytest.raises(DownloadCancelledError):
+        od.download_to_file(local_server.url + '/omni_min200601.asc', localfn, on_response=on_response,
+                            cancel=cancel)
+    assert responses == [True]
+    assert not os.path.exists(localfn)
+    assert not os.path.exists(localfn + '.part')
+
+
+def test_hedged_tier_needs_the_proxy(local_server):
+    """Test that the hedged tier races the proxy and NASA, and is plain NASA without proxy credentials"""
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    assert [tier.name for tier in build_tiers(od, [{'type': 'hedged'}])] == ['nasa']
+    tiers = build_tiers(od, [{'type': 'hedged', 'delay': .5}], proxy_url=local_server.url + '/proxy', proxy_key='key')
+    assert isinstance(tiers[0], omni_hedged_backend)
+    assert [backend.name for backend in tiers[0].backends] == ['proxy', 'nasa']
+    assert tiers[0].delay == .5
@@ -0,0 +1,112 @@
+import datetime
+import os
+import pytest
+import time
+
+import yadisk
+
+from nasaomnireader import omnireader
+from nasaomnireader.omni_backends import omni_dir_backend
+from nasaomnireader.omni_circuit_breaker import omni_circuit_breaker, CircuitOpenError
+
+
+def fail():
+    raise ConnectionError('down')
+
+
+def test_breaker_opens_and_closes():
+    """
+    Test that the breaker opens once enough calls failed, refuses calls
+    at once while open, and lets one trial through when half open
+    """
+    breaker = omni_circuit_breaker('nasa', failure_rate=.5, min_calls=4, open_seconds=.2)
+    for i in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    with pytest.raises(FileNotFoundError):
+        breaker.call(lambda: open('/no/such/file'))
+    assert not breaker.is_open()
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: 'not called')
+
+    time.sleep(.2)
+    assert not breaker.is_open()
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.state == 'open'
+    time.sleep(.2)
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.state == 'closed'
+
+
+class down_backend(omni_dir_backend):
+    """A tier which can not be reached"""
+    fetches = 0
+
+    def fetch(self, f, localfn):
+        down_backend.fetches += 1
+        raise ConnectionError(f"{self.name} is down")
+
+
+def test_fetch_fails_over_to_the_next_tier(tmp_path, minute_lines):
+    """Test that once a tier keeps failing it is no longer asked, the next tier is used at once"""
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    for month in range(1, 7):
+        with open(str(mirror / ('omni_min2006%.2d.asc' % month)), 'wb') as f:
+            f.write(minute_lines(datetime.datetime(2006, month, 1), 10))
+    down_backend.fetches = 0
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt',
+                                    tiers=[down_backend(str(mirror), name='down'), omni_dir_backend(str(mirror))])
+    for month in range(1, 7):
+        od.fetch_file(datetime.datetime(2006, month, 10), '1min')
+        assert od.cache_index.get('omni_min2006%.2d.asc' % month)['source'] == 'mirror'
+    assert down_backend.fetches == 4
+
+
+def test_interval_range_fails_over_to_nasa(local_server, fake_ya_disk, monkeypatch):
+    """Test that the interval's range is read from NASA when Yandex Disk can not be listed"""
+    def listdir(self, path, **kwargs):
+        raise yadisk.exceptions.YaDiskConnectionError(msg='down')
+    monkeypatch.setattr(fake_ya_disk, 'listdir', listdir)
+    local_server.files['/pub/data/omni/high_res_omni/monthly_1min/'] = (
+        b'<a href="omni_min200601.asc">omni_min200601.asc</a> <a href="omni_min200602.asc">omni_min200602.asc</a>')
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    startdt, enddt = od.fix_interval_yadisk(datetime.datetime(2005, 12, 1), datetime.datetime(2006, 1, 10), '1min',
+                                            proxy_url=local_server.url + '/proxy', proxy_key='key')
+    assert startdt >= datetime.datetime(2006, 1, 1)
+
+
+def test_cdf_interval_range_without_yadisk(fake_ya_disk, local_server, local_cdf_dir, monkeypatch):
+    """
+    Test that a CDF interval is not moved by the NASA listing (which only
+    has years) when Yandex Disk can not be listed: its last listing or the
+    cached files are used, and with neither it fails
+    """
+    def listdir(self, path, **kwargs):
+        raise yadisk.exceptions.YaDiskConnectionError(msg='down')
+    monkeypatch.setattr(fake_ya_disk, 'listdir', listdir)
+    local_server.files['/pub/data/omni/omni_cdaweb/hro_5min/'] = b'<a href="2006/">2006/</a>'
+    proxy = dict(proxy_url=local_server.url + '/proxy', proxy_key='key')
+    startdt, enddt = datetime.datetime(2006, 5, 10), datetime.datetime(2006, 5, 12)
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='cdf')
+    with pytest.raises(RuntimeError):
+        od.fix_interval_yadisk(startdt, enddt, '5min', **proxy)
+
+    for month in range(1, 7):
+        dt = datetime.datetime(2006, month, 1)
+        localfn = os.path.join(str(local_cdf_dir), od.filename_gen_yd['5min'](dt))
+        with open(localfn, 'wb') as f:
+            f.write(b'cdf')
+        od._record_fetch(dt, '5min', localfn, 'yadisk')
+    assert od.fix_interval_yadisk(startdt, enddt, '5min', **proxy) == (startdt, enddt)
+
+    key = omnireader.omni_listing_cache.key('yadisk', 'cdf', '/omni', '5min')
+    od.listing_cache.put(key, datetime.datetime(2006, 1, 1), datetime.datetime(2006, 5, 11))
+    monkeypatch.setattr(od.listing_cache, 'ttl', 0.)
+    assert od.fix_interval_yadisk(startdt, enddt, '5min', **proxy) == (
+        datetime.datetime(2006, 5, 8), datetime.datetime(2006, 5, 10))
+    assert not [path for path, headers in local_server.requests if 'hro_5min' in path]
@@ -0,0 +1,89 @@
+import datetime
+import os
+import pytest
+
+from nasaomnireader import omnireader
+from nasaomnireader.omni_backends import omni_dir_backend
+from nasaomnireader.omni_compression import append_file, compress_file, content_stat, is_compressed, open_file
+from nasaomnireader.omni_txt_cdf_mimic import omni_txt_cdf_mimic
+from nasaomnireader.omni_verify import verify_file, CorruptFileError
+
+
+@pytest.mark.parametrize('method', ['gzip', 'zstd'])
+def test_compress_and_append(tmp_path, minute_lines, method):
+    """Test that a compressed file, and members appended to it, read back as the original lines"""
+    if method == 'zstd':
+        pytest.importorskip('zstandard')
+    lines = minute_lines(datetime.datetime(2006, 1, 1), 200)
+    path = str(tmp_path / 'omni_min200601.asc')
+    with open(path, 'wb') as f:
+        f.write(lines[:len(lines) // 2])
+    assert compress_file(path, method)
+    assert is_compressed(path)
+    assert not compress_file(path, method)
+    assert os.path.getsize(path) < len(lines) // 4
+    offset = os.path.getsize(path)
+    with open(str(tmp_path / 'tail'), 'wb') as f:
+        f.write(lines[len(lines) // 2:])
+    append_file(path, str(tmp_path / 'tail'))
+    with open_file(path) as f:
+        assert f.read() == lines
+    with open_file(path, offset) as f:
+        assert f.read() == lines[len(lines) // 2:]
+    assert content_stat(path)[0] == len(lines)
+
+
+def test_compressed_text_files(tmp_path, local_server, minute_lines):
+    """
+    Test that fetched text files are stored compressed and read
+    transparently, and that refreshing one appends only its new lines
+    """
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    startdt = datetime.datetime(2006, 1, 1)
+    with open(str(mirror / 'omni_min200601.asc'), 'wb') as f:
+        f.write(minute_lines(startdt, 120))
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', compression='gzip',
+                                    tiers=[omni_dir_backend(str(mirror))])
+    localfn = od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    assert is_compressed(localfn)
+    assert od.cache_index.get('omni_min200601.asc')['size'] == os.path.getsize(localfn)
+    cdf = omni_txt_cdf_mimic(localfn, '1min')
+    assert len(cdf['Epoch'][:]) == 120
+
+    path = '/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'
+    local_server.files[path] = minute_lines(startdt, 180)
+    stored_size = os.path.getsize(localfn)
+    offset = od.refresh_tail(datetime.datetime(2006, 1, 10), '1min', proxy_url=local_server.url + '/proxy',
+                             proxy_key='key')
+    assert local_server.requests[-1][1]['Range'] == 'bytes=%d-' % len(minute_lines(startdt, 119))
+    assert offset == stored_size
+    assert cdf.extend(offset) == 60
+    assert cdf['Epoch'][-1] == startdt + datetime.timedelta(minutes=179)
+    with open_file(localfn) as f:
+        assert f.read() == local_server.files[path]
+
+
+def test_uploads_are_compressed(local_server, fake_ya_disk, minute_lines):
+    """Test that files copied to Yandex Disk are uploaded compressed under their own names"""
+    path = '/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'
+    local_server.files[path] = minute_lines(datetime.datetime(2006, 1, 1), 120)
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', compression='gzip')
+    assert od.load_from_nasa_to_yadisk(datetime.datetime(2006, 1, 10), '1min', local_server.url + '/proxy', 'key')
+    uploaded = os.path.join(fake_ya_disk.remote_dir, 'omni_min200601.asc')
+    assert is_compressed(uploaded)
+    with open_file(uploaded) as f:
+        assert f.read() == local_server.files[path]
+
+
+def test_cut_short_compressed_file_is_corrupt(tmp_path, minute_lines):
+    """Test that a compressed file cut short fails verification instead of reading as fewer lines"""
+    path = str(tmp_path / 'omni_min200601.asc')
+    with open(path, 'wb') as f:
+        f.write(minute_lines(datetime.datetime(2006, 1, 1), 200))
+    compress_file(path, 'gzip')
+    verify_file(path, 'txt', '1min')
+    with open(path, 'rb+') as f:
+        f.truncate(os.path.getsize(path) // 2)
+    with pytest.raises(CorruptFileError):
+        verify_file(path, 'txt', '1min')
@@ -0,0 +1,214 @@
+from nasaomnireader import omnireader
+import pytest
+import datetime, hashlib, os
+
+
+@pytest.fixture
+def download_dir(tmp_path):
+    download_dir = tmp_path / 'downloads'
+    download_dir.mkdir()
+    return download_dir
+
+
+@pytest.mark.parametrize('cdf_or_txt,cadence,n_files', [
+    ('cdf', 'hourly', 2),
+    ('cdf', '5min', 6),
+    ('cdf', '1min', 6),
+    ('txt', 'hourly', 1),
+    ('txt', '5min', 1),
+    ('txt', '1min', 6),
+])
+def test_plan_files_covers_interval(cdf_or_txt, cadence, n_files):
+    """
+    Test that the planned files for a six month interval
+    are worked out from the dates alone, one per file period
+    """
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt=cdf_or_txt)
+    files = od.plan_files(datetime.datetime(2006, 3, 14), datetime.datetime(2006, 8, 20), cadence)
+    assert len(files) == n_files
+    assert files[0].startdt <= datetime.datetime(2006, 3, 14) < files[0].enddt
+    assert files[-1].startdt < datetime.datetime(2006, 8, 20) <= files[-1].enddt
+    for f, next_f in zip(files[:-1], files[1:]):
+        assert f.enddt == next_f.startdt
+    assert all(f.filename == od.filename_gen_yd[cadence](f.startdt) for f in files)
+
+
+def test_plan_files_stops_at_file_boundary():
+    """
+    Test that an interval ending exactly at the start of
+    a file does not plan that file
+    """
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='cdf')
+    files = od.plan_files(datetime.datetime(2006, 3, 14), datetime.datetime(2006, 4, 1), '1min')
+    assert [f.filename for f in files] == ['omni_hro_1min_20060301_v01.cdf']
+
+
+def test_available_range_local_only_counts_own_format(local_cdf_dir):
+    """Test that the offline range of a downloader covers only the cached files in its format"""
+    cdf = omnireader.omni_downloader('token', '/omni', cdf_or_txt='cdf', tiers=[])
+    for month in [1, 2]:
+        dt = datetime.datetime(2010, month, 1)
+        localfn = os.path.join(str(local_cdf_dir), cdf.filename_gen_yd['5min'](dt))
+        with open(localfn, 'wb') as f:
+            f.write(b'cdf')
+        cdf._record_fetch(dt, '5min', localfn, 'yadisk')
+    txt = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    localfn = os.path.join(str(local_cdf_dir), txt.filename_gen_yd['5min'](datetime.datetime(2006, 1, 1)))
+    with open(localfn, 'wb') as f:
+        f.write(b'txt')
+    txt._record_fetch(datetime.datetime(2006, 1, 1), '5min', localfn, 'yadisk')
+    assert cdf.available_range_local('5min') == (datetime.datetime(2010, 1, 1), datetime.datetime(2010, 3, 1))
+    assert txt.available_range_local('5min') == (datetime.datetime(2006, 1, 1), datetime.datetime(2007, 1, 1))
+
+
+def test_download_to_file_streams_to_target(local_server, download_dir):
+    """Test that a streamed download ends up whole at the target, with no temp files left"""
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 0' * 100000
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    localfn = str(download_dir / 'omni_min200601.asc')
+    od.download_to_file(local_server.url + '/omni_min200601.asc', localfn)
+    with open(localfn, 'rb') as f:
+        assert f.read() == local_server.files['/omni_min200601.asc']
+    assert os.listdir(str(download_dir)) == ['omni_min200601.asc']
+
+
+def test_download_to_file_truncated_keeps_only_partial(local_server, download_dir, monkeypatch):
+    """
+    Test that a download which fails part way through does
+    not leave a truncated file that would look like a cached one
+    """
+    monkeypatch.setattr(omnireader, 'download_retries', 0)
+    monkeypatch.setattr(omnireader, 'download_chunk_size', 1000)
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 0' * 100000
+    local_server.truncate_after['/omni_min200601.asc'] = 1000
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    localfn = str(download_dir / 'omni_min200601.asc')
+    with pytest.raises(RuntimeError):
+        od.download_to_file(local_server.url + '/omni_min200601.asc', localfn)
+    assert sorted(os.listdir(str(download_dir))) == ['omni_min200601.asc.part', 'omni_min200601.asc.part.validator']
+    assert os.path.getsize(localfn + '.part') == 1000
+
+
+def test_download_to_file_resumes_only_same_version(local_server, download_dir, monkeypatch):
+    """
+    Test that resuming a partial file sends the first response's ETag as
+    If-Range, so a file changed since is downloaded whole, not mixed
+    """
+    monkeypatch.setattr(omnireader, 'download_retries', 0)
+    monkeypatch.setattr(omnireader, 'download_chunk_size', 1000)
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 0' * 100000
+    local_server.truncate_after['/omni_min200601.asc'] = 1000
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    url = local_server.url + '/omni_min200601.asc'
+    localfn = str(download_dir / 'omni_min200601.asc')
+    with pytest.raises(RuntimeError):
+        od.download_to_file(url, localfn)
+    etag = '"%s"' % hashlib.md5(local_server.files['/omni_min200601.asc']).hexdigest()
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 1' * 100000
+    assert od.download_to_file(url, localfn)
+    headers = local_server.requests[-1][1]
+    assert headers['Range'] == 'bytes=1000-'
+    assert headers['If-Range'] == etag
+    with open(localfn, 'rb') as f:
+        assert f.read() == local_server.files['/omni_min200601.asc']
+    assert os.listdir(str(download_dir)) == ['omni_min200601.asc']
+
+
+@pytest.mark.parametrize('supports_range', [True, False])
+def test_download_to_file_resumes(local_server, download_dir, monkeypatch, supports_range):
+    """
+    Test that a broken download is resumed from the partial file's size
+    with a Range request, or restarted if the server ignores Range
+    """
+    monkeypatch.setattr(omnireader, 'download_chunk_size', 1000)
+    local_server.supports_range = supports_range
+    body = bytes(range(256)) * 4000
+    local_server.files['/omni_hro_1min_20060101_v01.cdf'] = body
+    local_server.truncate_after['/omni_hro_1min_20060101_v01.cdf'] = 300000
+    od = omnireader.omni_downloader('token', '/omni')
+    localfn = str(download_dir / 'omni_hro_1min_20060101_v01.cdf')
+    od.download_to_file(local_server.url + '/omni_hro_1min_20060101_v01.cdf', localfn)
+    with open(localfn, 'rb') as f:
+        assert f.read() == body
+    assert os.listdir(str(download_dir)) == ['omni_hro_1min_20060101_v01.cdf']
+    assert len(local_server.requests) == 2
+    assert local_server.requests[1][1]['Range'] == 'bytes=300000-'
+
+
+def test_download_to_file_resumes_through_proxy(local_server, download_dir, monkeypatch):
+    """Test that the Range header is passed along with the proxy api key"""
+    monkeypatch.setattr(omnireader, 'download_chunk_size', 1000)
+    body = b'2006 1 0 0' * 100000
+    local_server.files['/pub/data/omni/omni_min200601.asc'] = body
+    local_server.truncate_after['/pub/data/omni/omni_min200601.asc'] = 5000
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    localfn = str(download_dir / 'omni_min200601.asc')
+    od.download_to_file('https://spdf.gsfc.nasa.gov/pub/data/omni/omni_min200601.asc', localfn,
+                        proxy_url=local_server.url + '/proxy', proxy_key='key')
+    with open(localfn, 'rb') as f:
+        assert f.read() == body
+    path, headers = local_server.requests[1]
+    assert headers['Range'] == 'bytes=5000-'
+    assert headers['apikey'] == 'key'
+    assert 'omni_min200601.asc' in path
+
+
+def test_download_to_file_revalidates(local_server, download_dir):
+    """
+    Test that revalidating a cached file costs one conditional
+    request when it has not changed, and downloads it when it has
+    """
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 0\n' * 1000
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    url = local_server.url + '/omni_min200601.asc'
+    localfn = str(download_dir / 'omni_min200601.asc')
+    assert od.download_to_file(url, localfn)
+    assert not od.download_to_file(url, localfn, revalidate=True)
+    assert 'If-None-Match' in local_server.requests[-1][1]
+    local_server.files['/omni_min200601.asc'] = b'2006 1 0 0\n' * 1001
+    assert od.download_to_file(url, localfn, revalidate=True)
+    with open(localfn, 'rb') as f:
+        assert f.read() == local_server.files['/omni_min200601.asc']
+
+
+def test_refresh_tail_fetches_only_new_bytes(local_server, minute_lines):
+    """
+    Test that refreshing a growing text file fetches it whole the first
+    time, then only the bytes added since, and nothing when it has not grown
+    """
+    path = '/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'
+    local_server.files[path] = minute_lines(datetime.datetime(2006, 1, 1), 1000)
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    proxy = dict(proxy_url=local_server.url + '/proxy', proxy_key='key')
+    dt = datetime.datetime(2006, 1, 10)
+    assert od.refresh_tail(dt, '1min', **proxy) == 0
+    size = len(local_server.files[path])
+    local_server.files[path] = minute_lines(datetime.datetime(2006, 1, 1), 1010)
+    assert od.refresh_tail(dt, '1min', **proxy) == size
+    # From the start of the cached last line, which must be unchanged
+    assert local_server.requests[-1][1]['Range'] == 'bytes=%d-' % (size - size // 1000)
+    with open(os.path.join(od.localdir, 'omni_min200601.asc'), 'rb') as f:
+        assert f.read() == local_server.files[path]
+    assert od.cache_index.get('omni_min200601.asc')['size'] == len(local_server.files[path])
+    assert od.refresh_tail(dt, '1min', **proxy) is None
+
+
+def test_refresh_tail_rewritten_file(local_server, minute_lines):
+    """
+    Test that a cached text file is fetched whole when NASA rewrote it
+    (its last line changed, or it got shorter), not extended
+    """
+    path = '/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'
+    local_server.files[path] = minute_lines(datetime.datetime(2006, 1, 1), 1000)
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    proxy = dict(proxy_url=local_server.url + '/proxy', proxy_key='key')
+    dt = datetime.datetime(2006, 1, 10)
+    localfn = os.path.join(od.localdir, 'omni_min200601.asc')
+    assert od.refresh_tail(dt, '1min', **proxy) == 0
+    for body in [minute_lines(datetime.datetime(2006, 1, 1, 0, 1), 1010),
+                 minute_lines(datetime.datetime(2006, 1, 1), 900)]:
+        local_server.files[path] = body
+        assert od.refresh_tail(dt, '1min', **proxy) == 0
+        assert 'Range' not in local_server.requests[-1][1]
+        with open(localfn, 'rb') as f:
+            assert f.read() == body
@@ -0,0 +1,37 @@
+from nasaomnireader import omni_file_lock as omni_file_lock_module
+from nasaomnireader.omni_file_lock import omni_file_lock
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+@pytest.mark.skipif(omni_file_lock_module.fcntl is None, reason="cross-process locks need fcntl")
+def test_lock_held_by_another_process(tmp_path):
+    """Test that a lock taken by another process is waited for"""
+    localfn = str(tmp_path / 'omni_min200601.asc')
+    held = tmp_path / 'held'
+    child = subprocess.Popen([sys.executable, '-c', (
+        "import sys, time\n"
+        "from nasaomnireader.omni_file_lock import omni_file_lock\n"
+        "with omni_file_lock(sys.argv[1]):\n"
+        "    open(sys.argv[2], 'w').close()\n"
+        "    time.sleep(.5)\n"), localfn, str(held)])
+    try:
+        while not held.exists():
+            time.sleep(.01)
+        start = time.monotonic()
+        with omni_file_lock(localfn):
+            assert time.monotonic() - start >= .3
+    finally:
+        child.wait()
+    assert child.returncode == 0
+
+
+def test_locks_on_different_files(tmp_path):
+    """Test that locks on different files do not wait for each other and are dropped once unused"""
+    with omni_file_lock(str(tmp_path / 'a')):
+        with omni_file_lock(str(tmp_path / 'b')):
+            pass
+    assert omni_file_lock._thread_locks == dict()
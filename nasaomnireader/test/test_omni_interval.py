@@ -0,0 +1,303 @@
+import nasaomnireader.omni_interval
+import nasaomnireader.omni_listing_cache
+import nasaomnireader.omni_yadisk_pool
+import pytest
+import numpy as np
+import datetime, os, pkgutil
+
+pytestmark = pytest.mark.skipif(pkgutil.find_loader('spacepy') is None,
+                                reason="requires spacepy.pycdf, CDF reading library")
+
+_fillval = -1.0e31
+
+
+def write_5min_cdf(path, month_start):
+    """Write a small stand-in for a monthly 5 minute OMNI CDF"""
+    from spacepy import pycdf
+    year, month = month_start.year, month_start.month
+    next_month = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    n = int((next_month - month_start).total_seconds() // 300)
+    epoch = [month_start + datetime.timedelta(minutes=5 * i) for i in range(n)]
+    cdf = pycdf.CDF(path, '')
+    cdf.attrs['TITLE'] = 'test'
+    cdf.new('Epoch', epoch, type=pycdf.const.CDF_EPOCH)
+    cdf['Epoch'].attrs['FILLVAL'] = datetime.datetime(9999, 12, 31, 23, 59, 59, 999000)
+    for i, var in enumerate(['BX_GSE', 'BY_GSM', 'BZ_GSM', 'proton_density']):
+        values = np.arange(n, dtype=np.float32) + i
+        if var == 'proton_density':
+            values[::10] = _fillval
+        cdf[var] = values
+        cdf[var].attrs['FILLVAL'] = np.float32(_fillval)
+    cdf.close()
+
+
+@pytest.fixture
+def fake_remote(fake_ya_disk):
+    """A Yandex Disk folder holding 5 minute CDFs for the first half of 2006"""
+    for month in range(1, 7):
+        dt = datetime.datetime(2006, month, 1)
+        write_5min_cdf(os.path.join(fake_ya_disk.remote_dir, 'omni_hro_5min_%d%.2d01_v01.cdf' % (dt.year, dt.month)),
+                       dt)
+    return fake_ya_disk
+
+
+def make_interval(startdt, enddt, **kwargs):
+    return nasaomnireader.omni_interval.omni_interval(startdt, enddt, '5min', 'token', '/omni', silent=True, **kwargs)
+
+
+def test_omni_interval_opens_only_planned_files(fake_remote):
+    """
+    Test that an interval spanning three months downloads and
+    opens exactly the three files in the plan
+    """
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 4, 20))
+    assert len(oi.cdfs) == 3
+    assert len(fake_remote.downloads) == 3
+    epoch = oi['Epoch']
+    assert epoch[0] == datetime.datetime(2006, 2, 10)
+    assert epoch[-1] == datetime.datetime(2006, 4, 19, 23, 55)
+    assert len(oi['BZ_GSM']) == len(epoch)
+
+
+def test_omni_interval_opens_files_lazily(fake_remote):
+    """
+    Test that building an interval spanning several files opens none of
+    them, and that the indices found without opening them match the data
+    """
+    startdt = datetime.datetime(2006, 2, 10, 0, 2)
+    oi = make_interval(startdt, datetime.datetime(2006, 4, 20, 12))
+    assert not any(cdf.is_open for cdf in oi.cdfs)
+    assert oi.si == np.searchsorted(oi.cdfs[0]['Epoch'][:], startdt)
+    assert [cdf.is_open for cdf in oi.cdfs] == [True, False, False]
+    assert oi.ei == np.searchsorted(oi.cdfs[-1]['Epoch'][:], datetime.datetime(2006, 4, 20, 12))
+    assert oi['Epoch'][0] == datetime.datetime(2006, 2, 10, 0, 5)
+    assert oi['Epoch'][-1] == datetime.datetime(2006, 4, 20, 11, 55)
+    assert oi.cdfs[1].is_open
+
+
+def test_omni_interval_results_are_cached(fake_remote, monkeypatch):
+    """
+    Test that reading a variable again does not read the files again,
+    and that the cached arrays can not be changed by callers
+    """
+    from nasaomnireader.omni_lazy_file import omni_lazy_file
+    reads = []
+    getitem = omni_lazy_file.__getitem__
+    monkeypatch.setattr(omni_lazy_file, '__getitem__', lambda self, var: reads.append(var) or getitem(self, var))
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 4, 20))
+    bz = oi['BZ_GSM']
+    n_reads = len(reads)
+    assert oi['BZ_GSM'] is bz
+    assert len(reads) == n_reads
+    with pytest.raises(ValueError):
+        bz[0] = 0.
+    oi.add_transform('BZ_GSM', ['5min'], lambda x: -x, 'Flip')
+    assert oi['BZ_GSM'][0] == -bz[0]
+    assert len(reads) > n_reads
+
+
+def test_omni_interval_force_download_downloads_once(fake_remote):
+    """
+    Test that with force_download each file of the interval is downloaded
+    once, by the prefetch, and not again when it is opened or reopened
+    """
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 4, 20), force_download=True)
+    oi['BZ_GSM']
+    assert len(fake_remote.downloads) == 3
+    oi.cdfs[-1].close()
+    oi['BY_GSM']
+    assert len(fake_remote.downloads) == 3
+
+
+def test_omni_interval_ending_on_file_boundary(fake_remote):
+    """
+    Test that an interval ending exactly at the start of a file
+    does not need that file
+    """
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 3, 1))
+    assert len(oi.cdfs) == 1
+    assert oi['Epoch'][-1] == datetime.datetime(2006, 2, 28, 23, 55)
+
+
+def test_omni_interval_fill_values_are_nan(fake_remote):
+    """Test that fill values come back as NaN"""
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 4, 20))
+    n = oi['proton_density']
+    assert np.count_nonzero(np.isnan(n)) > 0
+    assert not np.any(n == _fillval)
+
+
+def test_omni_interval_reads_files_into_one_array(fake_remote):
+    """
+    Test that a variable spanning several files comes back as the files'
+    records in order, defilled, and keeping the files' dtype
+    """
+    oi = make_interval(datetime.datetime(2006, 2, 10, 0, 2), datetime.datetime(2006, 4, 20, 12))
+    expected = np.concatenate([oi.cdfs[0]['proton_density'][oi.si:], oi.cdfs[1]['proton_density'][:],
+                               oi.cdfs[2]['proton_density'][:oi.ei]])
+    expected[expected == _fillval] = np.nan
+    n = oi['proton_density']
+    assert n.dtype == np.float32
+    np.testing.assert_array_equal(n, expected)
+    assert len(oi['Epoch']) == len(n)
+
+
+def test_omni_interval_revalidate_downloads_only_changed(fake_remote):
+    """
+    Test that revalidating cached files re-downloads only
+    the ones that changed on Yandex Disk
+    """
+    startdt, enddt = datetime.datetime(2006, 2, 10), datetime.datetime(2006, 4, 20)
+    make_interval(startdt, enddt)
+    assert len(fake_remote.downloads) == 3
+    make_interval(startdt, enddt, revalidate=True)
+    assert len(fake_remote.downloads) == 3
+    with open(os.path.join(fake_remote.remote_dir, 'omni_hro_5min_20060301_v01.cdf'), 'ab') as f:
+        f.write(b'updated')
+    make_interval(startdt, enddt, revalidate=True)
+    assert fake_remote.downloads[3:] == ['/omni/omni_hro_5min_20060301_v01.cdf']
+
+
+def test_omni_interval_revalidates_each_file_once(fake_remote, monkeypatch):
+    """Test that an unchanged file is checked on Yandex Disk once, by the prefetch, not again when opened"""
+    startdt, enddt = datetime.datetime(2006, 2, 10), datetime.datetime(2006, 4, 20)
+    make_interval(startdt, enddt)
+    checked = []
+    get_meta = fake_remote.get_meta
+    monkeypatch.setattr(fake_remote, 'get_meta', lambda self, path, **kwargs: checked.append(path) or get_meta(
+        self, path, **kwargs))
+    oi = make_interval(startdt, enddt, revalidate=True)
+    oi['BZ_GSM']
+    assert len(checked) == 3
+    assert len(fake_remote.downloads) == 3
+
+
+def test_omni_interval_listing_is_cached(fake_remote):
+    """
+    Test that building many intervals lists the Yandex Disk
+    folder once, and shares one client
+    """
+    for day in range(1, 10):
+        oi = make_interval(datetime.datetime(2006, 2, day), datetime.datetime(2006, 2, day + 1))
+    assert fake_remote.listings == 1
+    assert fake_remote.instances == 1
+
+
+def test_omni_interval_shifted_into_available_range(fake_remote):
+    """Test that an interval past the last available file is moved back inside the available range"""
+    oi = make_interval(datetime.datetime(2006, 7, 10), datetime.datetime(2006, 7, 12))
+    assert oi.enddt <= datetime.datetime(2006, 7, 1)
+    assert oi.enddt - oi.startdt == datetime.timedelta(days=2)
+
+
+def test_omni_interval_files_pinned_until_closed(fake_remote):
+    """
+    Test that a small local cache budget removes old files but not
+    the ones used by an open interval
+    """
+    oi = make_interval(datetime.datetime(2006, 1, 10), datetime.datetime(2006, 2, 20))
+    oi.dwnldr.local_cache.max_bytes = 1
+    assert oi.dwnldr.local_cache.evict() == []
+    oi.close()
+    assert sorted(oi.dwnldr.local_cache.evict()) == ['omni_hro_5min_20060101_v01.cdf',
+                                                      'omni_hro_5min_20060201_v01.cdf']
+
+
+def test_omni_interval_files_recorded_in_cache_index(fake_remote):
+    """Test that the downloaded files are in the cache index with their cadence, span and source"""
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 3, 20))
+    cached = oi.dwnldr.cache_index.cached('5min')
+    assert sorted(cached) == ['omni_hro_5min_20060201_v01.cdf', 'omni_hro_5min_20060301_v01.cdf']
+    entry = cached['omni_hro_5min_20060301_v01.cdf']
+    assert entry['startdt'] == '2006-03-01T00:00:00'
+    assert entry['enddt'] == '2006-04-01T00:00:00'
+    assert entry['source'] == 'yadisk'
+    assert entry['size'] == os.path.getsize(os.path.join(oi.dwnldr.localdir, 'omni_hro_5min_20060301_v01.cdf'))
+    assert all(f.cached for f in oi.dwnldr.plan_files(oi.startdt, oi.enddt, '5min'))
+
+
+def test_omni_interval_indexes_files_cached_before_index(fake_remote, local_cdf_dir):
+    """Test that files already in localdir but missing from the index are used, not downloaded again"""
+    write_5min_cdf(os.path.join(str(local_cdf_dir), 'omni_hro_5min_20060201_v01.cdf'), datetime.datetime(2006, 2, 1))
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 2, 20))
+    assert fake_remote.downloads == []
+    entry = oi.dwnldr.cache_index.get('omni_hro_5min_20060201_v01.cdf')
+    assert entry['cadence'] == '5min'
+    assert entry['source'] is None
+
+
+def test_omni_interval_offline_uses_local_files(fake_remote):
+    """
+    Test that an offline interval is answered from the files in
+    localdir without any Yandex Disk client, and fails fast when
+    a needed file is missing
+    """
+    make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 3, 20))
+    instances = fake_remote.instances
+    nasaomnireader.omni_yadisk_pool.get_yadisk_pool().close()
+    nasaomnireader.omni_listing_cache.get_listing_cache().clear()
+
+    oi = make_interval(datetime.datetime(2006, 2, 15), datetime.datetime(2006, 3, 10), offline=True)
+    assert oi['Epoch'][0] == datetime.datetime(2006, 2, 15)
+    # Shifted into the span of the local files
+    oi = make_interval(datetime.datetime(2006, 3, 25), datetime.datetime(2006, 4, 5), offline=True)
+    assert oi.enddt <= datetime.datetime(2006, 4, 1)
+    assert fake_remote.instances == instances
+    assert fake_remote.listings == 1
+
+
+def test_omni_interval_offline_missing_file(fake_remote):
+    """Test that a gap in the local files is reported without touching the network"""
+    make_interval(datetime.datetime(2006, 1, 10), datetime.datetime(2006, 1, 20))
+    make_interval(datetime.datetime(2006, 3, 10), datetime.datetime(2006, 3, 20))
+    downloads = list(fake_remote.downloads)
+    with pytest.raises(nasaomnireader.omnireader.OfflineCacheMissError):
+        make_interval(datetime.datetime(2006, 1, 25), datetime.datetime(2006, 3, 5), offline=True)
+    assert fake_remote.downloads == downloads
+
+
+def test_omni_interval_refresh_extends_text_file(fake_ya_disk, local_server, minute_lines):
+    """
+    Test that refreshing an interval of text files fetches only the new
+    lines of its last file and extends it up to the new end
+    """
+    startdt = datetime.datetime(2006, 1, 1)
+    with open(os.path.join(fake_ya_disk.remote_dir, 'omni_min200601.asc'), 'wb') as f:
+        f.write(minute_lines(startdt, 120))
+    path = '/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'
+    local_server.files[path] = minute_lines(startdt, 180)
+    oi = nasaomnireader.omni_interval.omni_interval(startdt + datetime.timedelta(minutes=30),
+                                                    startdt + datetime.timedelta(minutes=110), '1min', 'token',
+                                                    '/omni', silent=True, cdf_or_txt='txt')
+    assert len(oi['Epoch']) == 80
+    assert oi.refresh(enddt=startdt + datetime.timedelta(minutes=170), proxy_url=local_server.url + '/proxy',
+                      proxy_key='key')
+    assert local_server.requests[-1][1]['Range'] == 'bytes=%d-' % len(minute_lines(startdt, 119))
+    epoch = oi['Epoch']
+    assert len(epoch) == 140
+    assert epoch[-1] == startdt + datetime.timedelta(minutes=169)
+    assert not np.any(np.isnan(oi['BZ_GSM']))
+
+
+def test_omni_interval_reads_ahead(fake_remote, monkeypatch):
+    """
+    Test that the months after an interval are fetched in the
+    background, within the read-ahead byte budget, and used by the
+    next interval without fetching them again
+    """
+    oi = make_interval(datetime.datetime(2006, 2, 10), datetime.datetime(2006, 2, 20), readahead=2)
+    oi.dwnldr.readahead_threads.wait()
+    assert sorted(fake_remote.downloads) == ['/omni/omni_hro_5min_20060201_v01.cdf',
+                                             '/omni/omni_hro_5min_20060301_v01.cdf',
+                                             '/omni/omni_hro_5min_20060401_v01.cdf']
+    make_interval(datetime.datetime(2006, 3, 10), datetime.datetime(2006, 3, 20))
+    assert len(fake_remote.downloads) == 3
+
+    # Read-ahead files are taken to be the size of the one opened
+    size = os.path.getsize(os.path.join(fake_remote.remote_dir, 'omni_hro_5min_20060401_v01.cdf'))
+    # The read-ahead threads are shared by the process, the budget is put back after the test
+    monkeypatch.setattr(oi.dwnldr.readahead_threads, 'max_bytes', int(size * 1.5))
+    make_interval(datetime.datetime(2006, 4, 10), datetime.datetime(2006, 4, 20), readahead=2)
+    oi.dwnldr.readahead_threads.wait()
+    # April was used, so May fits in the budget but June does not
+    assert fake_remote.downloads[3:] == ['/omni/omni_hro_5min_20060501_v01.cdf']
@@ -0,0 +1,20 @@
+from nasaomnireader.omni_listing_cache import omni_listing_cache
+import datetime
+
+
+def test_listing_cache_expires():
+    """Test that entries are forgotten once older than the TTL"""
+    cache = omni_listing_cache(ttl=60.)
+    key = omni_listing_cache.key('yadisk', 'cdf', '/omni', '5min')
+    cache.put(key, datetime.datetime(1995, 1, 1), datetime.datetime(2020, 2, 1))
+    assert cache.get(key) == (datetime.datetime(1995, 1, 1), datetime.datetime(2020, 2, 1))
+    cache.ttl = -1.
+    assert cache.get(key) is None
+
+
+def test_listing_cache_on_disk(tmp_path):
+    """Test that a cache saved to disk is picked up by a new instance"""
+    path = str(tmp_path / 'omni_listing_cache.json')
+    key = omni_listing_cache.key('nasa', 'txt', '/pub/data/omni/high_res_omni/', '5min')
+    omni_listing_cache(path=path).put(key, datetime.datetime(1981, 1, 1), datetime.datetime(2020, 1, 1))
+    assert omni_listing_cache(path=path).get(key) == (datetime.datetime(1981, 1, 1), datetime.datetime(2020, 1, 1))
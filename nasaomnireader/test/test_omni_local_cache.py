@@ -0,0 +1,39 @@
+from nasaomnireader.omni_local_cache import omni_local_cache
+import os
+import time
+
+
+def write_file(cache, filename, nbytes):
+    """Write a file to the cache directory and add it to the index, as a download does"""
+    with open(os.path.join(cache.localdir, filename), 'wb') as f:
+        f.write(b'0' * nbytes)
+    cache.cache_index.put(filename, size=nbytes, fetched_at=time.time())
+
+
+def test_evict_least_recently_used(local_cdf_dir):
+    """Test that the least recently used files are removed first until under budget"""
+    cache = omni_local_cache(str(local_cdf_dir), max_bytes=2500)
+    for month in range(1, 5):
+        fn = 'omni_hro_1min_2006%.2d01_v01.cdf' % month
+        write_file(cache, fn, 1000)
+        cache.touch(fn)
+        time.sleep(.01)
+    cache.touch('omni_hro_1min_20060101_v01.cdf')
+    assert cache.evict() == ['omni_hro_1min_20060201_v01.cdf', 'omni_hro_1min_20060301_v01.cdf']
+    assert sorted(cache.cached_files()) == ['omni_hro_1min_20060101_v01.cdf', 'omni_hro_1min_20060401_v01.cdf']
+
+
+def test_pinned_files_are_kept(local_cdf_dir):
+    """Test that pinned files are never evicted, and can be once unpinned"""
+    cache = omni_local_cache(str(local_cdf_dir), max_bytes=500)
+    write_file(cache, 'omni_min200601.asc', 1000)
+    cache.pin(['omni_min200601.asc'])
+    assert cache.evict() == []
+    cache.unpin(['omni_min200601.asc'])
+    assert cache.evict() == ['omni_min200601.asc']
+
+
+def test_no_budget_keeps_everything(local_cdf_dir):
+    cache = omni_local_cache(str(local_cdf_dir))
+    write_file(cache, 'omni_min200601.asc', 1000)
+    assert cache.evict() == []
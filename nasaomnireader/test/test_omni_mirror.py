@@ -0,0 +1,65 @@
+from nasaomnireader.omni_mirror import omni_mirror
+import datetime
+import os
+
+import yadisk
+
+# Stand-in CDFs only need the CDF magic number, the mirror's worker threads check nothing else
+cdf_magic = b'\xcd\xf3\x00\x01'
+
+
+def test_mirror_copies_only_missing_files(fake_ya_disk, local_server, local_cdf_dir):
+    """
+    Test that mirroring a range uploads the files missing from
+    Yandex Disk, in parallel, leaving no temporary files behind
+    """
+    for month in range(1, 7):
+        fn = 'omni_hro_5min_2006%.2d01_v01.cdf' % month
+        local_server.files['/pub/data/omni/omni_cdaweb/hro_5min/2006/' + fn] = cdf_magic + fn.encode() * 1000
+    for month in [1, 2]:
+        with open(os.path.join(fake_ya_disk.remote_dir, 'omni_hro_5min_2006%.2d01_v01.cdf' % month), 'wb') as f:
+            f.write(b'already mirrored')
+
+    mirror = omni_mirror('token', '/omni', cdf_or_txt='cdf', max_workers=3,
+                         proxy_url=local_server.url + '/proxy', proxy_key='key')
+    result = mirror.run(datetime.datetime(2006, 1, 1), datetime.datetime(2006, 7, 1), ['5min'])
+
+    assert sorted(result['uploaded']) == ['omni_hro_5min_2006%.2d01_v01.cdf' % month for month in range(3, 7)]
+    assert result['skipped'] == []
+    for month in range(3, 7):
+        fn = 'omni_hro_5min_2006%.2d01_v01.cdf' % month
+        with open(os.path.join(fake_ya_disk.remote_dir, fn), 'rb') as f:
+            assert f.read() == cdf_magic + fn.encode() * 1000
+    assert [fn for fn in os.listdir(str(local_cdf_dir)) if fn.endswith('.upload') or fn.endswith('.part')] == []
+
+
+def test_mirror_skips_missing_remote_files(fake_ya_disk, local_server):
+    """Test that files NASA does not have are reported as skipped"""
+    mirror = omni_mirror('token', '/omni', cdf_or_txt='cdf',
+                         proxy_url=local_server.url + '/proxy', proxy_key='key')
+    result = mirror.run(datetime.datetime(2006, 1, 1), datetime.datetime(2006, 2, 1), ['1min'])
+    assert result == {'uploaded': [], 'skipped': ['omni_hro_1min_20060101_v01.cdf']}
+
+
+def test_mirror_skips_corrupt_and_failed_files(fake_ya_disk, local_server, monkeypatch):
+    """
+    Test that a file arriving corrupt is not uploaded, and that a failed
+    upload is reported as skipped without stopping the other files
+    """
+    for month, body in [(1, b'<html>Service Unavailable</html>'), (2, cdf_magic + b'fail'), (3, cdf_magic + b'ok')]:
+        fn = 'omni_hro_5min_2006%.2d01_v01.cdf' % month
+        local_server.files['/pub/data/omni/omni_cdaweb/hro_5min/2006/' + fn] = body
+    upload = fake_ya_disk.upload
+
+    def failing_upload(self, src_path, dst_path, **kwargs):
+        if dst_path.endswith('20060201_v01.cdf'):
+            raise yadisk.exceptions.YaDiskError(msg='upload failed')
+        return upload(self, src_path, dst_path, **kwargs)
+    monkeypatch.setattr(fake_ya_disk, 'upload', failing_upload)
+
+    mirror = omni_mirror('token', '/omni', cdf_or_txt='cdf', max_workers=2,
+                         proxy_url=local_server.url + '/proxy', proxy_key='key')
+    result = mirror.run(datetime.datetime(2006, 1, 1), datetime.datetime(2006, 4, 1), ['5min'])
+    assert result['uploaded'] == ['omni_hro_5min_20060301_v01.cdf']
+    assert sorted(result['skipped']) == ['omni_hro_5min_20060101_v01.cdf', 'omni_hro_5min_20060201_v01.cdf']
+    assert os.listdir(fake_ya_disk.remote_dir) == ['omni_hro_5min_20060301_v01.cdf']
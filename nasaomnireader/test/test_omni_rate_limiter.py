@@ -0,0 +1,108 @@
+from nasaomnireader import omnireader, omni_rate_limiter
+from nasaomnireader.omni_backends import build_tiers
+from nasaomnireader.omni_rate_limiter import omni_rate_limiter as rate_limiter, ToManyRequestsError
+import datetime
+import pytest
+import threading
+import time
+
+
+def test_token_bucket_paces_requests():
+    """Test that after the burst, requests start at most rate per second"""
+    limiter = rate_limiter(rate=50., burst=2)
+    start = time.monotonic()
+    for i in range(7):
+        limiter.call(lambda: None)
+    # 2 at once, then 5 more at 50 per second
+    assert time.monotonic() - start >= .09
+
+
+def test_retry_honours_retry_after():
+    """Test that a throttled call is retried after the server's Retry-After, and concurrency halved"""
+    limiter = rate_limiter(max_concurrent=8, backoff_base=.001)
+    answers = [ToManyRequestsError('slow down', retry_after=.05), ToManyRequestsError('slow down', retry_after=.05)]
+
+    def request():
+        if answers:
+            raise answers.pop(0)
+        return 'ok'
+
+    start = time.monotonic()
+    assert limiter.call(request) == 'ok'
+    assert time.monotonic() - start >= .1
+    assert limiter.concurrency == 2
+
+
+def test_retries_give_up():
+    limiter = rate_limiter(retries=2, backoff_base=.001)
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise ToManyRequestsError('slow down')
+
+    with pytest.raises(ToManyRequestsError):
+        limiter.call(request)
+    assert len(calls) == 3
+    assert limiter.active == 0
+
+
+def test_concurrency_grows_back_and_is_enforced():
+    """Test that concurrency grows by one after as many successes and limits requests at once"""
+    limiter = rate_limiter(max_concurrent=4)
+    limiter.concurrency = 2
+    running, most = [0], [0]
+    lock = threading.Lock()
+
+    def request():
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(.01)
+        with lock:
+            running[0] -= 1
+
+    threads = [threading.Thread(target=limiter.call, args=(request,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most[0] <= 3
+    assert limiter.concurrency == 3
+
+
+def test_parse_retry_after():
+    assert omni_rate_limiter.parse_retry_after('120') == 120.
+    assert omni_rate_limiter.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.
+    assert omni_rate_limiter.parse_retry_after('soon') is None
+
+
+def test_shared_limiters_have_the_same_limits(local_server):
+    """
+    Test that requests made by the downloader itself (e.g. when copying
+    to Yandex Disk) get the configured concurrency of their server, and
+    that asking for other limits for a server's limiter is an error
+    """
+    limiter = omni_rate_limiter.get_rate_limiter('nasa')
+    assert limiter.max_concurrent == limiter.concurrency == omni_rate_limiter.default_max_concurrent['nasa']
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    assert build_tiers(od, [{'type': 'nasa'}])[0].limiter is limiter
+    assert build_tiers(od, [{'type': 'nasa', 'max_concurrent': limiter.max_concurrent}])[0].limiter is limiter
+    with pytest.raises(ValueError):
+        build_tiers(od, [{'type': 'nasa', 'max_concurrent': 16}])
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_fetch_retries_throttled_proxy(local_server, status, minute_lines):
+    """Test that 429 and 5xx answers from the proxy are retried instead of failing the download"""
+    local_server.files['/pub/data/omni/high_res_omni/monthly_1min/omni_min200601.asc'] = minute_lines(
+        datetime.datetime(2006, 1, 1), 10)
+    local_server.status_codes = [(status, '0.2'), (status, None)]
+    omni_rate_limiter.get_rate_limiter('proxy', backoff_base=.01)
+    start = time.monotonic()
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt', tiers=[])
+    od.tiers = build_tiers(od, [{'type': 'proxy'}], proxy_url=local_server.url + '/proxy', proxy_key='key')
+    od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    assert len(local_server.requests) == 3
+    assert time.monotonic() - start >= .2
+    assert od.cache_index.get('omni_min200601.asc')['source'] == 'proxy'
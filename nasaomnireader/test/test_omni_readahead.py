@@ -0,0 +1,39 @@
+import collections
+import sqlite3
+import threading
+
+from nasaomnireader.omni_readahead import omni_readahead
+
+planned = collections.namedtuple('planned', ['filename', 'localfn', 'startdt', 'cadence'])
+
+
+class failing_downloader(object):
+    """Fails the first fetch with an error no fetch is expected to raise, then writes the files"""
+
+    def __init__(self):
+        self.fetches = []
+
+    def fetch_file(self, dt, cadence):
+        self.fetches.append(dt)
+        if len(self.fetches) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        with open(dt, 'wb') as f:
+            f.write(b'read ahead')
+
+
+def test_unexpected_error_does_not_stop_reading_ahead(tmp_path):
+    """
+    Test that a read-ahead thread survives an unexpected error, so the
+    files scheduled after it are still fetched and wait() returns
+    """
+    readahead = omni_readahead(workers=1)
+    dwnldr = failing_downloader()
+    files = [planned(fn, str(tmp_path / fn), str(tmp_path / fn), '1min') for fn in ['jan', 'feb']]
+    for f in files:
+        assert readahead.schedule(dwnldr, f, 10)
+    waiter = threading.Thread(target=readahead.wait, daemon=True)
+    waiter.start()
+    waiter.join(5.)
+    assert not waiter.is_alive()
+    assert len(dwnldr.fetches) == 2
+    assert readahead.pending == {files[1].localfn: len(b'read ahead')}
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from nasaomnireader.omni_result_cache import omni_result_cache
+
+
+def test_result_cache_evicts_least_recently_used():
+    """Test that the cache keeps under its budget by forgetting the least recently used arrays"""
+    cache = omni_result_cache(max_bytes=3 * 800)
+    for name in ['a', 'b', 'c']:
+        cache.put(name, np.zeros(100))
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(100))
+    assert cache.get('b') is None
+    assert [name for name in ['a', 'c', 'd'] if cache.get(name) is not None] == ['a', 'c', 'd']
+    assert cache.total_bytes == 3 * 800
+    big = cache.put('big', np.zeros(1000))
+    assert cache.get('big') is None
+    assert not big.flags.writeable
+
+
+def test_cached_arrays_are_read_only():
+    cache = omni_result_cache()
+    data = cache.put('a', np.arange(10.))
+    with pytest.raises(ValueError):
+        data[0] = 1.
+    assert cache.get('a')[0] == 0.
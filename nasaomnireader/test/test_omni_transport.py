@@ -0,0 +1,24 @@
+from nasaomnireader import omnireader
+from nasaomnireader.omni_transport import omni_transport, get_transport
+
+
+def test_get_response_reuses_connection(local_server):
+    """
+    Test that repeated requests from different downloaders
+    go over one kept-alive connection
+    """
+    transport = omni_transport(pool_size=2)
+    local_server.files['/pub/data/omni/'] = b'omni_hro_1min_20060101_v01.cdf'
+    for _ in range(3):
+        od = omnireader.omni_downloader('token', '/omni', transport=transport)
+        response = od.get_response(local_server.url + '/pub/data/omni/', None, None)
+        assert response.content == b'omni_hro_1min_20060101_v01.cdf'
+    assert len(local_server.client_ports) == 1
+    transport.close()
+
+
+def test_shared_transport_is_shared():
+    """Test that downloaders share the process-wide transport by default"""
+    od1 = omnireader.omni_downloader('token', '/omni')
+    od2 = omnireader.omni_downloader('token', '/omni')
+    assert od1.transport is od2.transport is get_transport()
@@ -0,0 +1,105 @@
+import errno
+import datetime
+import os
+import pytest
+
+from nasaomnireader import omnireader
+from nasaomnireader.omni_backends import omni_dir_backend, omni_yadisk_backend
+from nasaomnireader.omni_verify import verify_file, CorruptFileError
+
+
+def write_file(directory, filename, body):
+    with open(os.path.join(str(directory), filename), 'wb') as f:
+        f.write(body)
+
+
+def test_verify_file(tmp_path, minute_lines):
+    """Test that whole text files pass and cut short, mangled or non OMNI files do not"""
+    good = minute_lines(datetime.datetime(2006, 1, 1), 10)
+    write_file(tmp_path, 'good.asc', good)
+    verify_file(str(tmp_path / 'good.asc'), 'txt', '1min')
+    bad = {'cut.asc': good[:-20],
+           'html.asc': b'<html><body>Service Unavailable</body></html>\n',
+           'empty.asc': b'',
+           'columns.asc': b'2006 1 0 0\n' * 10,
+           'mixed.asc': good + b'2006 1 0 10 1.5\n'}
+    for filename, body in bad.items():
+        write_file(tmp_path, filename, body)
+        with pytest.raises(CorruptFileError):
+            verify_file(str(tmp_path / filename), 'txt', '1min')
+    write_file(tmp_path, 'html.cdf', b'<html></html>')
+    with pytest.raises(CorruptFileError):
+        verify_file(str(tmp_path / 'html.cdf'), 'cdf', '5min')
+
+
+def test_verify_5min_file(tmp_path):
+    """Test that 5 minute text files, which have the proton fluxes after the 1 minute columns, pass"""
+    line = ('2006   1  0  0   71   71   64    1      286    0  0.99     8.02    3.61    -6.88    -2.08    -6.88'
+            '    -2.08    -6.57    -3.08     -9.5    -4.2     -1.8    37.7  99999.9  99999.9  99999.9   9.53   11.7'
+            '  20.23   1.23 -999.99 -999.99 -999.99 -999.99 -999.99 -999.99 -999.99   9.9  9.86   -31   -12   -25'
+            '   -24   9.9    5.2   2.24     9.12   0.10   0.03\n')
+    assert len(line.split()) == 49
+    write_file(tmp_path, 'omni_5min200601.asc', line.encode() * 10)
+    verify_file(str(tmp_path / 'omni_5min200601.asc'), 'txt', '5min')
+    with pytest.raises(CorruptFileError):
+        verify_file(str(tmp_path / 'omni_5min200601.asc'), 'txt', '1min')
+
+
+def test_corrupt_file_is_quarantined(tmp_path, fake_ya_disk, minute_lines):
+    """
+    Test that a file which arrives corrupt is moved to the quarantine
+    directory and fetched from the next tier instead
+    """
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    good = minute_lines(datetime.datetime(2006, 1, 1), 10)
+    write_file(mirror, 'omni_min200601.asc', good[:-20])
+    write_file(fake_ya_disk.remote_dir, 'omni_min200601.asc', good)
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt',
+                                    tiers=[omni_dir_backend(str(mirror)), omni_yadisk_backend('token', '/omni')])
+    localfn = od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    with open(localfn, 'rb') as f:
+        assert f.read() == good
+    entry = od.cache_index.get('omni_min200601.asc')
+    assert entry['source'] == 'yadisk'
+    assert entry['verified_at'] is not None
+    quarantined = os.listdir(os.path.join(od.localdir, 'quarantine'))
+    assert len(quarantined) == omnireader.corrupt_retries + 1
+    assert all(fn.startswith('omni_min200601.asc.') for fn in quarantined)
+
+
+def test_cached_files_are_verified_once(monkeypatch, fake_ya_disk, minute_lines):
+    """
+    Test that a file cached without being verified (e.g. by an older
+    version) is checked when used, replaced if corrupt, and not checked again
+    """
+    good = minute_lines(datetime.datetime(2006, 1, 1), 10)
+    write_file(fake_ya_disk.remote_dir, 'omni_min200601.asc', good)
+    write_file(omnireader.localdir, 'omni_min200601.asc', good[:-20])
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    assert od.cache_index.get('omni_min200601.asc')['verified_at'] is None
+    localfn = od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    with open(localfn, 'rb') as f:
+        assert f.read() == good
+    assert fake_ya_disk.downloads == ['/omni/omni_min200601.asc']
+
+    checked = []
+    monkeypatch.setattr(omnireader, 'verify_file', lambda *args: checked.append(args))
+    od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    assert checked == []
+    assert fake_ya_disk.downloads == ['/omni/omni_min200601.asc']
+
+
+def test_corrupt_file_removed_when_it_can_not_be_quarantined(monkeypatch, fake_ya_disk, minute_lines):
+    """Test that a corrupt cached file which can not be moved to quarantine_dir is removed, and fetched again"""
+    def move(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(omnireader.shutil, 'move', move)
+    good = minute_lines(datetime.datetime(2006, 1, 1), 10)
+    write_file(fake_ya_disk.remote_dir, 'omni_min200601.asc', good)
+    write_file(omnireader.localdir, 'omni_min200601.asc', good[:-20])
+    od = omnireader.omni_downloader('token', '/omni', cdf_or_txt='txt')
+    localfn = od.fetch_file(datetime.datetime(2006, 1, 10), '1min')
+    with open(localfn, 'rb') as f:
+        assert f.read() == good
+    assert od.cache_index.get('omni_min200601.asc')['verified_at'] is not None
@@ -0,0 +1,49 @@
+from nasaomnireader import omni_yadisk_pool
+import threading
+import time
+
+
+class slow_client(object):
+    running = 0
+    most_running = 0
+    lock = threading.Lock()
+
+    def __init__(self, token=None, **kwargs):
+        self.token = token
+
+    def listdir(self, path, **kwargs):
+        with slow_client.lock:
+            slow_client.running += 1
+            slow_client.most_running = max(slow_client.most_running, slow_client.running)
+        time.sleep(.05)
+        with slow_client.lock:
+            slow_client.running -= 1
+        return []
+
+    def close(self):
+        pass
+
+
+def test_pool_limits_concurrent_operations(monkeypatch):
+    """
+    Test that threads share one client per token and that no more
+    than max_concurrent operations run at once with it
+    """
+    monkeypatch.setattr(omni_yadisk_pool.yadisk, 'YaDisk', slow_client)
+    pool = omni_yadisk_pool.omni_yadisk_pool(max_concurrent=2)
+    clients = []
+
+    def list_folder():
+        with pool.client('token') as y:
+            clients.append(y)
+            y.listdir('/omni')
+
+    threads = [threading.Thread(target=list_folder) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(id(client) for client in clients)) == 1
+    assert slow_client.most_running == 2
+    with pool.client('other token') as y:
+        assert y is not clients[0]
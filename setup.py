@@ -23,6 +23,9 @@ setup(name='nasaomnireader',
       install_requires=['numpy','matplotlib','scipy','requests'],
       packages=['nasaomnireader'],
       package_dir={'nasaomnireader' : 'nasaomnireader'},
+      entry_points = {
+            'console_scripts': ['omni_mirror=nasaomnireader.omni_mirror:main']
+            },
       license='LICENSE.txt',
       zip_safe = False,
       classifiers = [